@@ -1,16 +1,14 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
+import time
+_STARTED=time.time()    # For --startup-time
 from Tkinter import *
 from ttk import *
 from ScrolledText import ScrolledText as Text
-from PIL import Image, ImageTk
-import tkFileDialog,os,cairo,tempfile,time,shutil,tkFont
-from laveqed import laveqed
-from rsvg_windows import rsvg_windows
-try:
-    import rsvg
-except ImportError:
-    rsvg=rsvg_windows()	# Untested
+import tkFileDialog,os,sys,tempfile,shutil,tkFont,threading,Queue,re
+from collections import OrderedDict
+from laveqed import laveqed, scratchDir, _cacheDir
+Image=ImageTk=cairo=rsvg=None   # Imported by _importGraphics(), off the startup path
 
 
 TITLE = 'laveqed GUI'
@@ -18,12 +16,159 @@ APP_WIN_WIDTH = 800
 APP_WIN_HEIGHT = 400
 FONTNAME='Ubuntu Mono'
 LOGOFILENAME='laveqed_logo.svg'
+INSTALLDIR=os.path.dirname(os.path.abspath(__file__))   # Before any chdir, __file__ may be relative
 CONFIGFILE='laveqed_config.xml'
+LIVEDELAY=400   # ms of idle typing before a live preview render
+ZOOMDELAY=150   # ms without zooming before the preview is rendered at full quality
+RASTERCACHE=64*2**20    # Bytes of rendered previews kept for zooming
+
+# Syntax highlight tokens, the group name is the tag applied
+_SYNTAX=re.compile(r'(?P<blue>%.*)'     # Comment until EOL
+                   r'|(?P<red>\\\\|\\%|\^|[-.]?[0-9]\.?(?: ?pt)?)'   # \\ \% ^ numbers, sizes
+                   r'|(?P<green>\\(?:[a-zA-Z]+|[!#&$,;:]))'    # \alpha \! \# \& \$ \, \; \:
+                   r'|(?P<purple>[\[\]{}()])'
+                   r'|(?P<bold>&)')     # Alignment
+
+
+class _SyntaxHighlighter(object):
+    # Highlights a Text widget, re-tokenizing only the lines touched by edits.
+    # The widget's Tcl command is wrapped to see every insert/delete/replace,
+    # undo and redo included; Tk moves the tags of untouched lines by itself.
+
+    def __init__(self, text):
+        self.text=text
+        self._orig=text._w+'_orig'
+        text.tk.call('rename',text._w,self._orig)
+        text.tk.createcommand(text._w,self._dispatch)
+        text.bind('<Destroy>',self._close,add='+')
+        self.dirty=(1,self._line('end'))
+
+    def _close(self, event=None):
+        # Tk removes the renamed widget command, not the wrapper
+        try:
+            self.text.tk.deletecommand(self.text._w)
+        except TclError:
+            pass
+
+    def _line(self, index):
+        return int(self.text.tk.call(self._orig,'index',index).split('.')[0])
+
+    def _dispatch(self, command, *args):
+        # Like idlelib's WidgetRedirector: an error raised here would come out of
+        # mainloop(), even for the calls Tk's bindings make inside catch (get
+        # sel.first with no selection, edit undo with nothing to undo...)
+        try:
+            if command in ('insert','delete','replace') and args:
+                self._edited(command,args)
+            return self.text.tk.call((self._orig,command)+args)
+        except TclError:
+            return ''
+
+    def _edited(self, command, args):
+        # Marks the lines of an edit about to be made as dirty, moving the dirty
+        # lines below it by the number of lines it adds or removes
+        first=self._line(args[0])
+        added=removed=0
+        if command=='insert':
+            added=sum(i.count('\n') for i in args[1::2])
+        else:
+            end=args[1] if len(args)>1 else args[0]+'+1c'
+            removed=self.text.tk.call(self._orig,'get',args[0],end).count('\n')
+            if command=='replace':
+                added=sum(i.count('\n') for i in args[2::2])
+        last=first+added
+        if self.dirty is not None:
+            top,bottom=[max(first,i+added-removed) if i>first else i for i in self.dirty]
+            first,last=min(first,top),max(last,bottom)
+        self.dirty=(first,last)
+
+    def highlight(self):
+        if self.dirty is None:
+            return
+        first,last=self.dirty
+        self.dirty=None
+        start,end='{}.0'.format(first),'{}.end'.format(last)
+        for i in ['red','purple','green','blue','bold']:
+            self.text.tag_remove(i,start,end)
+        for n,line in enumerate(self.text.get(start,end).split('\n'),first):
+            for m in _SYNTAX.finditer(line):
+                self.text.tag_add(m.lastgroup,'{}.{}'.format(n,m.start()),'{}.{}'.format(n,m.end()))
+
+
+# PIL, pycairo and rsvg (which dlopens librsvg) are slow to import: a thread
+# loads them while the window comes up, the first user waits for it if needed
+_graphicsLock=threading.Lock()
+def _importGraphics():
+    global Image,ImageTk,cairo,rsvg
+    with _graphicsLock:
+        if rsvg is not None:
+            return
+        from PIL import Image, ImageTk
+        import cairo
+        try:
+            import rsvg as _rsvg
+        except ImportError:
+            from rsvg_windows import rsvg_windows
+            _rsvg=rsvg_windows()	# Untested
+        rsvg=_rsvg
+
+
+# Current resident memory of the process in bytes (peak if /proc is missing)
+def _rss():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1])*os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024
+
+
+# 'latex 412, dvisvgm 88 ms' from laveqed's stage timings of a render
+def _breakdown(timings):
+    if [k for k in timings if k!='render']==['cache']:
+        return 'cached'
+    return ', '.join('{} {:.0f}'.format(k,1000*v) for k,v in timings.items() \
+            if k!='render' and v>=0.0005)+' ms'
+
+
+class _RasterCache(object):
+    # Rendered previews (PIL images) keyed on (file, mtime, scale), least
+    # recently used ones dropped past maxbytes
+
+    def __init__(self, maxbytes=RASTERCACHE):
+        self.maxbytes=maxbytes
+        self.size=0
+        self._images=OrderedDict()
+
+    def get(self, key):
+        image=self._images.pop(key,None)
+        if image is not None:
+            self._images[key]=image   # Most recently used
+        return image
+
+    def put(self, key, image):
+        size=image.size[0]*image.size[1]*4
+        if size>self.maxbytes:
+            return
+        if key in self._images:
+            self.size-=self._nbytes(self._images.pop(key))
+        while self.size+size>self.maxbytes:
+            self.size-=self._nbytes(self._images.popitem(last=False)[1])
+        self._images[key]=image
+        self.size+=size
+
+    def _nbytes(self, image):
+        return image.size[0]*image.size[1]*4
+
 
 class laveqed_gui(object):
 
-    def __init__(self, title):
+    def __init__(self, title, measure=False):
         print('Starting \t\t:\tWelcome in laveqed\'s GUI!')
+        self.measure = measure  # Reports the startup time, then quits
+        self._graphics = threading.Thread(target=_importGraphics)
+        self._graphics.daemon = True
+        self._graphics.start()
         os.environ['XMODIFIERS'] = "@im=none" # Fix for non-working ^ after a while
         self.win=Tk()
         self.win.title(title)
@@ -32,12 +177,29 @@ class laveqed_gui(object):
         self.previewSize=(713,45)
         self._topLevelOpened = False
         self.displayScale = 1
+        self._rasters = _RasterCache()
+        self._zoomAfter = None  # Pending full quality render after zooming
+        self._surface = None    # Reused by every preview render
+
+        # Renders run on a worker thread; results come back through a queue
+        self._renderJobs = Queue.Queue()
+        self._renderResults = Queue.Queue()
+        self._renderID = 0  # Id of the latest request, older ones are superseded
+        self._running = None    # laveqed object the worker is rendering
+        self._renderThread = threading.Thread(target=self._renderWorker)
+        self._renderThread.daemon = True
+        self._renderThread.start()
+        self.liveDelay = LIVEDELAY
+        self._liveAfter = None  # Pending live preview render
+        self._lastRendered = None   # LaTeX code of the last successful render
+        self._rendered = None   # and its laveqed object
 
         self.buildGUI()
         self._set_vars() # Sets variables for use by laveqed, also creates temp folder and cd into it
-        self._makelogo() # Either loads pre-calculated logo or generates it.
+        self._makelogo() # Loads a pre-rendered logo once the graphics modules are in, or builds it
 
         self.text_widget.focus() # So we can type right away!
+        self.win.after(50, self._pollRender)
 
 
     def _buildFrames(self):
@@ -54,6 +216,10 @@ class laveqed_gui(object):
         self.png_frame=Label(self.top_frame,anchor='center')
         self.png_frame.pack(fill='both', expand=True, padx=4, pady=4)
 
+        # Last render's latency, from request (keystroke in live preview) to pixels
+        self.status_bar=Label(self.main_frame,anchor='e')
+        self.status_bar.pack(side='bottom', fill=X, expand=False, padx=8)
+
         self.bottom_frame=LabelFrame(self.main_frame,relief=FLAT)
         self.bottom_frame.pack(side='bottom', fill=X, expand=False, padx=4, pady=4)
         
@@ -109,6 +275,8 @@ class laveqed_gui(object):
         # laveqed menu
         laveqedmenu=Menu(self.menubar,tearoff=0)
         laveqedmenu.add_command(label='Run',command=self.build_svg,accelerator='Ctrl-Enter')
+        self.livePreview=BooleanVar(self.win,False)
+        laveqedmenu.add_checkbutton(label='Live preview',variable=self.livePreview,accelerator='Ctrl-L')
         laveqedmenu.add_command(label='Preferences',command=self.preferences,accelerator='Ctrl-P')
         self.menubar.add_cascade(label="laveqed", menu=laveqedmenu)
         
@@ -126,14 +294,16 @@ class laveqed_gui(object):
             self.eqonly=False   # Loads -ambles by default if eqonly == False
         # Creating a temporary folder to work inside of
         self.owd=os.getcwd()    # Original Working Directory, for friendly fileOpenDialog
-        self.cwd=tempfile.mkdtemp()
+        self.cwd=tempfile.mkdtemp(prefix='laveqed-gui-',dir=scratchDir())
         print('Making temp folder\t:\t'+self.cwd)
         os.chdir(self.cwd)
 
-        try :
-            shutil.copy2(self.owd+'/'+LOGOFILENAME,self.cwd+'/'+LOGOFILENAME)
-        except:
-            pass
+        # Logo from the launch folder, else the one built by a previous launch,
+        # else the one shipped with laveqed
+        for i in [self.owd,_cacheDir(),INSTALLDIR]:
+            if os.path.isfile(os.path.join(i,LOGOFILENAME)):
+                shutil.copy2(os.path.join(i,LOGOFILENAME),os.path.join(self.cwd,LOGOFILENAME))
+                break
          
 
     def _binding(self):
@@ -144,10 +314,12 @@ class laveqed_gui(object):
         self.win.bind('<Control-s>',self.save_svg)
         self.win.bind('<Control-o>',self.open_svg_fixCtrlO)
         self.win.bind('<Control-p>', self.preferences)
+        self.win.bind('<Control-l>', self.toggle_live)
         self.win.bind('<Control-q>',self.close)
         # Text widget binds
         self.text_widget.bind('<Control-h>',self.hat)
         self.text_widget.bind('<KeyRelease>',self.set_syntax)
+        self.text_widget.bind('<KeyRelease>',self.schedule_live,add='+')
         # SVG binds
         self.win.bind('<Control-plus>', self.ZoomInSVG)
         self.win.bind('<Control-minus>', self.ZoomOutSVG)
@@ -156,12 +328,39 @@ class laveqed_gui(object):
 
     def _makelogo(self):
         self.name=LOGOFILENAME[:-4]
-        if not os.path.isfile(LOGOFILENAME):
-            equation=r'\text{L\hspace{-3.5pt}\raisebox{2pt}{\scriptsize A}\!}{\color{gray!68}\text{\TeX}}\text{ V{\color{gray!80}ectorial} Eq{\color{gray!80}uation} Ed{\color{gray!80}itor}}'
-            self.text_widget.insert('1.0',equation)
-            self.build_svg()
-            self.text_widget.delete('1.0',END)
-        self.load_svg()
+        if os.path.isfile(LOGOFILENAME):
+            self._showLogo()
+            return
+        # Built on a thread like any preview, and kept for the next launches
+        equation=r'\text{L\hspace{-3.5pt}\raisebox{2pt}{\scriptsize A}\!}{\color{gray!68}\text{\TeX}}\text{ V{\color{gray!80}ectorial} Eq{\color{gray!80}uation} Ed{\color{gray!80}itor}}'
+        tmp=laveqed(equation,name=self.name,scale=self.scale)
+        tmp.preamble=self.preamble
+        tmp.postamble=self.postamble
+        print('Building svg\t\t:\t'+LOGOFILENAME)
+        self._renderID+=1
+        thread=threading.Thread(target=self._buildLogo,args=(self._renderID,tmp,time.time()))
+        thread.daemon=True
+        thread.start()
+
+    def _buildLogo(self, renderID, tmp, started):
+        # Runs on its own thread, never touches Tk
+        data=None
+        try:
+            tmp.makesvg()
+            shutil.copy2(tmp.name+'.svg',os.path.join(_cacheDir(),LOGOFILENAME))
+            with open(tmp.name+'.svg','rb') as f:
+                data=f.read()
+            error=None
+        except Exception as e:
+            error=e
+        self._renderResults.put((renderID,tmp,error,started,data))
+
+    def _showLogo(self):
+        # Waits for the graphics modules without blocking the event loop
+        if self._graphics.is_alive():
+            self.win.after(10, self._showLogo)
+        elif self.name==LOGOFILENAME[:-4]:  # Nothing rendered in the meantime
+            self.load_svg()
 
 
 
@@ -185,11 +384,13 @@ class laveqed_gui(object):
         win.geometry('{}x{}+{}+{}'.format(width, height, x, y))
 
 
-    def load_svg(self,event=None):
+    def load_svg(self,event=None,data=None):
+        # data: the svg file's content if already in memory
+        _importGraphics()
         filename=self.name+'.svg'
         if os.path.isfile(filename):
             #self.tk_image=self.svgPhotoImage(filename, scale=self.displayScale)
-            self.openDisplaySVG(filename)
+            self.openDisplaySVG(filename,data)
 
             print('Loading svg file\t:\t'+filename+' (Success!)')
         # If opening failed, put a blank image the same size as SVGLOGOFILE
@@ -202,6 +403,7 @@ class laveqed_gui(object):
 
         
     def close(self,var=None):
+        print('Memory\t\t\t:\t'+self.memory_stats())
         print('Removing temp folder\t:\t'+self.cwd)
         shutil.rmtree(self.cwd) # Removing the temporary folder we worked in
         print("Exiting\t\t\t:\tCiao!")
@@ -221,8 +423,20 @@ class laveqed_gui(object):
         self.text_widget.delete(INSERT, '%s+1c'%INSERT)
 
     def run(self):
+        if self.measure:
+            self.win.update()   # Mapped and drawn, the editor takes input from here on
+            print('Startup\t\t\t:\tFirst interactive frame after {:.0f} ms'.format(\
+                    1000*(time.time()-_STARTED)))
+            self.win.after(10, self._measureLogo)
         self.win.mainloop()
 
+    def _measureLogo(self):
+        if getattr(self, 'tk_image', None) is None and time.time()-_STARTED<60:
+            self.win.after(10, self._measureLogo)
+            return
+        print('Startup\t\t\t:\tLogo shown after {:.0f} ms'.format(1000*(time.time()-_STARTED)))
+        self.close()
+
 
 
     def build_preferences(self, pref, event=None):
@@ -234,6 +448,8 @@ class laveqed_gui(object):
                 font=(FONTNAME,12), undo=True)
         scale_label = Label(pref, text='Scale:')
         scale_entry = Entry(pref, width = 2)
+        delay_label = Label(pref, text='Live preview delay (ms):')
+        delay_entry = Entry(pref, width = 5)
         save_button = Button(pref, text='OK')
         
         padval=10
@@ -249,6 +465,10 @@ class laveqed_gui(object):
                 pady=(0,padval))
         scale_entry.grid(row=5, column=0, sticky='w', padx=50,\
                 pady=(0,padval))
+        delay_label.grid(row=5, column=0, sticky='w', padx=90,\
+                pady=(0,padval))
+        delay_entry.grid(row=5, column=0, sticky='w', padx=255,\
+                pady=(0,padval))
         save_button.grid(row=5, column=0, sticky='e', padx=padval,\
                 pady=(0,padval))
 
@@ -259,6 +479,7 @@ class laveqed_gui(object):
         pre_text.insert('1.0', self.preamble)
         post_text.insert('1.0', self.postamble)
         scale_entry.insert(0, self.scale)
+        delay_entry.insert(0, self.liveDelay)
 
         self._tag_configure(pre_text)
         self._tag_configure(post_text)
@@ -278,6 +499,10 @@ class laveqed_gui(object):
             self.postamble = os.linesep.join([s for s \
                     in post_text.get('1.0', END).splitlines() if s.strip()])
             self.scale = scale_entry.get()
+            try:
+                self.liveDelay = max(0, int(delay_entry.get()))
+            except ValueError:
+                pass
             print('Editing Preferences\t:\tSaving Preferences')
             pref._destroy()
 
@@ -321,35 +546,138 @@ class laveqed_gui(object):
         # Fixes accidental <Return> catched by text_widget when <C-Return> is pressed
         self.fixCtrlReturn() 
         self.build_svg()
-    def build_svg(self,event=None):
-        self.name=time.strftime('%Y-%m-%d_%H-%M-%S')  # Temp filename is time in seconds since epoch. 
-            # Strips first char in case it's a '-' which latex understands as an argument 
-        print('Building svg\t\t:\t'+self.name+'.svg')
-        equation=os.linesep.join([s for s \
-                in self.text_widget.get('1.0',END).splitlines() if s.strip()])
-            # Removes empty lines so latex doesn't freak out
-        tmp=laveqed(equation,name=self.name,scale=self.scale,cleanAfter=False,eqonly=self.eqonly)
+    def build_svg(self,event=None,started=None):
+        # Temp filename is the time, plus a counter so renders in the same second don't collide
+        name='{}_{}'.format(time.strftime('%Y-%m-%d_%H-%M-%S'),self._renderID+1)
+        print('Building svg\t\t:\t'+name+'.svg')
+        tmp=laveqed(self._equation(),name=name,scale=self.scale,eqonly=self.eqonly)
         tmp.preamble=self.preamble
         tmp.postamble=self.postamble
-        print('\n\t======= LaTeX output begins =======')
+        # Pending renders are superseded by this one, a running one is cancelled
+        self._renderID+=1
         try:
-            tmp.makesvg()
-            print('\t=======  LaTeX output ends  =======\n')
-            self.load_svg()
-        except:
-            print('\t======= LaTeX output ends =======\n')
-            print('Error building svg file\t:\tCheck LaTeX Syntax')
+            while True:
+                self._renderJobs.get_nowait()
+        except Queue.Empty:
+            pass
+        running=self._running
+        if running is not None:
+            running.cancel()
+        self._renderJobs.put((self._renderID,tmp,started or time.time()))
+        self._setBusy(True)
+
+    def _equation(self):
+        # Removes empty lines so latex doesn't freak out
+        return os.linesep.join([s for s \
+                in self.text_widget.get('1.0',END).splitlines() if s.strip()])
+
+    def toggle_live(self,event=None):
+        self.livePreview.set(not self.livePreview.get())
+
+    def schedule_live(self,event=None):
+        # Bursts of keystrokes are coalesced: only the last one, once typing
+        # has been idle for liveDelay ms, triggers a render
+        if not self.livePreview.get():
+            return
+        if self._liveAfter is not None:
+            self.win.after_cancel(self._liveAfter)
+        self._liveAfter=self.win.after(self.liveDelay,self._live_render,time.time())
+
+    def _live_render(self,started):
+        self._liveAfter=None
+        if (self.preamble,self._equation(),self.postamble,str(self.scale))==self._lastRendered:
+            return  # Nothing new to see
+        self.build_svg(started=started)   # Replaces any render still waiting in the queue
+
+    def _renderWorker(self):
+        # Runs on its own thread, never touches Tk
+        while True:
+            renderID,tmp,started=self._renderJobs.get()
+            if renderID!=self._renderID:
+                continue
+            self._running=tmp
+            if renderID!=self._renderID:    # Superseded before build_svg could see it
+                tmp.cancel()
+            data=None
+            try:
+                tmp.makesvg_incremental()  # Long align* blocks only redo the rows that changed, see save_svg
+                with open(tmp.name+'.svg','rb') as f:
+                    data=f.read()    # The main thread renders straight from memory
+                error=None
+            except Exception as e:
+                error=e
+            self._running=None
+            self._renderResults.put((renderID,tmp,error,started,data))
+
+    def _pollRender(self):
+        try:
+            while True:
+                renderID,tmp,error,started,data=self._renderResults.get_nowait()
+                if renderID!=self._renderID:
+                    print('Building svg\t\t:\t'+tmp.name+'.svg (Superseded)')
+                    continue
+                self._setBusy(False)
+                if error is None:
+                    self.name=tmp.name
+                    self._rendered=tmp
+                    self._lastRendered=(tmp.preamble,tmp.equation,tmp.postamble,str(tmp.scale))
+                    self.load_svg(data=data)
+                    self.win.update_idletasks()  # Pixels on screen
+                    self.status_bar.config(text='Rendered in {:.0f} ms ({})    {}'.format(\
+                            1000*(time.time()-started),_breakdown(tmp.timings),self.memory_stats()))
+                else:
+                    print('Error building svg file\t:\t'+str(error))
+                    self.status_bar.config(text=str(error))
+        except Queue.Empty:
+            pass
+        self.win.after(50, self._pollRender)
+
+    def _setBusy(self, busy):
+        # Busy indicator drawn over the current preview
+        self.png_frame.config(text='Rendering...' if busy else '', compound='center')
 
 
     def save_svg(self,event=None):
         print('Saving svg\t\t:\tOpening Dialog')
         filename=tkFileDialog.asksaveasfilename(filetypes=[('laveqed SVG file','.svg')],\
                 initialdir=self.owd,defaultextension='.svg',initialfile=self.name+'.svg')
+        if not filename:
+            print('Saving svg\t\t:\tOperation cancelled')
+            return
+        eq=self._rendered
+        if eq is not None and eq.name==self.name and 'compose' in eq.timings:
+            # The preview was put together row by row (laveqed_rows), the saved
+            # svg is the one laveqed makes from the whole block, on a thread
+            full=laveqed(eq.equation,name=filename,scale=eq.scale)
+            full.preamble,full.postamble=eq.preamble,eq.postamble
+            thread=threading.Thread(target=self._saveFull,args=(full,))
+            thread.daemon=True
+            thread.start()
+            self.status_bar.config(text='Saving '+filename+'...')
+            self.win.after(50,self._pollSave,thread,full)
+            return
         try:
             shutil.copy2(self.name+'.svg',filename)
             print('Saving svg\t\t:\tFile saved as '+filename)
-        except:
-            print('Saving svg\t\t:\tOperation cancelled')
+        except Exception as e:
+            print('Saving svg\t\t:\tFailed ('+str(e)+')')
+
+    def _saveFull(self, full):
+        # Runs on its own thread, never touches Tk
+        try:
+            full.makesvg()
+        except Exception as e:
+            full.error=e
+
+    def _pollSave(self, thread, full):
+        if thread.is_alive():
+            self.win.after(50,self._pollSave,thread,full)
+        elif full.error is None:
+            print('Saving svg\t\t:\tFile saved as '+full.name+'.svg')
+            self.status_bar.config(text='Saved '+full.name+'.svg')
+        else:
+            print('Saving svg\t\t:\tFailed ('+str(full.error)+')')
+            self.status_bar.config(text='Saving failed: '+str(full.error))
         
     def open_svg_fixCtrlO(self,event=None):
         # Fixes accidental linebreak at INSERT+1 catched by text_widget when <C-o> is pressed
@@ -378,43 +706,16 @@ class laveqed_gui(object):
             self.set_syntax()
 
 
-    def highlight_pattern(self, event, pattern, tag, start="1.0", end="end", regexp=False):
-        # Adapted from http://bit.ly/UMdj9q
-        '''Apply the given tag to all text that matches the given pattern
-        If 'regexp' is set to True, pattern will be treated as a regular expression
-        '''
-
-        start = event.index(start)
-        end = event.index(end)
-        event.mark_set("matchStart",start)
-        event.mark_set("matchEnd",start)
-        event.mark_set("searchLimit", end)
-
-        count = IntVar()
-        while True:
-            index = event.search(pattern, "matchEnd","searchLimit",
-                                count=count, regexp=regexp)
-            if index == "": break
-            event.mark_set("matchStart", index)
-            event.mark_set("matchEnd", "%s+%sc" % (index,count.get()))
-            event.tag_add(tag, "matchStart","matchEnd")
-
     def _set_syntax(self, text):
         # \\ ^ & and numbers including reals and size in "pt" -> red
         # {}[] -> purple
         # \alpha or (\!\#\&\$\,\;\:) -> green
         # % until EOL is comment (blue)
         # Alignment '&' is bold
-
-        # First clearing all tags. e.g. avoids '{}<left>A' to color '{A}' all in purple
-        for i in ['red','purple','green','blue','bold']:
-            text.tag_remove(i,'1.0','end')
-        # Parsing the text and setting tags
-        self.highlight_pattern(text,r'\\\\|\^|([-\.]?|^)[0-9]\.?(pt| pt)?|\\%','red',regexp=True)       
-        self.highlight_pattern(text,r'[\[\]\{\}\(\)]', 'purple',regexp=True)           
-        self.highlight_pattern(text,r'\\([a-zA-Z]+|[!#&\$,;:])', 'green',regexp=True)
-        self.highlight_pattern(text,r'([^\\]|^)%.*','blue',regexp=True)
-        self.highlight_pattern(text,r'&','bold',regexp=True)
+        # Only the lines edited since the last call are tokenized again (see _SYNTAX)
+        if not hasattr(text,'highlighter'):
+            text.highlighter=_SyntaxHighlighter(text)
+        text.highlighter.highlight()
 
     def set_syntax(self, event=None):
         self._set_syntax(self.text_widget)
@@ -440,6 +741,7 @@ class laveqed_gui(object):
         
     def svgPhotoImage(self,file_path_name, scale=1): # TODO Fix (if can be) AA artefacts at sharp alpha edges
         "Returns a ImageTk.PhotoImage object represeting the svg file" 
+        _importGraphics()
         # Based on pygame.org/wiki/CairoPygame and http://bit.ly/1hnpYZY        
         svg = rsvg.Handle(path=file_path_name)
         width, height = svg.get_dimension_data()[:2]
@@ -455,35 +757,62 @@ class laveqed_gui(object):
 
 
 
-    def openSVG(self, file_path_name):
-        svg = rsvg.Handle(path=file_path_name)
+    def openSVG(self, file_path_name, data=None):
+        if getattr(self, 'openedSVG', None) is not None:
+            self.openedSVG['svg'].close()   # Frees the previous librsvg object
+        if data is not None:
+            svg = rsvg.Handle(data=data)
+        else:
+            svg = rsvg.Handle(path=file_path_name)
         width, height = svg.get_dimension_data()[:2]
-        self.openedSVG = dict(svg=svg, width=width, height=height)
+        self.openedSVG = dict(svg=svg, width=width, height=height, image=None,\
+                key=(file_path_name, os.path.getmtime(file_path_name)))
 
 
-    def updateOpenedSVG(self):
-        svg = self.openedSVG['svg']
-        width = self.openedSVG['width']
-        height = self.openedSVG['height']
-
+    def updateOpenedSVG(self, fast=False):
+        # fast: shows the last full quality image resized, the real render
+        # follows once zooming has paused for ZOOMDELAY ms
+        if self._zoomAfter is not None:
+            self.win.after_cancel(self._zoomAfter)
+            self._zoomAfter = None
         scale = self.displayScale
-
-        surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, int(width*scale), int(height*scale))
-        context = cairo.Context(surface)
-        context.scale(scale,scale)
-        context.set_antialias(cairo.ANTIALIAS_DEFAULT)
-        svg.render_cairo(context)
-        tk_image=ImageTk.PhotoImage('RGBA')
-        image=Image.frombuffer('RGBA',(int(width*scale),int(height*scale)),surface.get_data(),'raw','BGRA',0,1)
-        tk_image.paste(image)
-
-        self.tk_image = tk_image
+        key = self.openedSVG['key']+(round(scale,6),)
+        image = self._rasters.get(key)
+        if image is None and fast and self.openedSVG['image'] is not None:
+            size = (max(1,int(self.openedSVG['width']*scale)), max(1,int(self.openedSVG['height']*scale)))
+            self._showImage(self.openedSVG['image'].resize(size, Image.BILINEAR))
+            self._zoomAfter = self.win.after(ZOOMDELAY, self.updateOpenedSVG)
+            return
+        if image is None:
+            image = self._rasterize(scale)
+            self._rasters.put(key, image)
+        self.openedSVG['image'] = image
+        self._showImage(image)
+
+    def _rasterize(self, scale):
+        # Renders into the same cairo surface every time its size allows it; the
+        # BGRA -> RGBA decode is the only copy before Tk's own
+        self._surface = self.openedSVG['svg'].render_surface(scale, self._surface)
+        size = (self._surface.get_width(), self._surface.get_height())
+        return Image.frombuffer('RGBA',size,self._surface.get_data(),'raw','BGRA',0,1)
+
+    def _showImage(self, image):
+        # Pastes into the current PhotoImage when the size allows it
+        if not isinstance(getattr(self, 'tk_image', None), ImageTk.PhotoImage)\
+                or (self.tk_image.width(), self.tk_image.height()) != image.size:
+            self.tk_image = ImageTk.PhotoImage('RGBA', image.size)
         self.tk_image.paste(image)
         self.png_frame.config(image=self.tk_image)
 
     
-    def openDisplaySVG(self, file_path_name):
-        self.openSVG(file_path_name)
+    def memory_stats(self):
+        # Resident memory and what the previews hold on to
+        return 'RSS {:.1f} MB, {} svg handle(s), {} preview(s) cached ({:.1f} MB)'.format(\
+                _rss()/2.**20, getattr(getattr(rsvg, 'Handle', None), 'opened', 0),\
+                len(self._rasters._images), self._rasters.size/2.**20)
+
+    def openDisplaySVG(self, file_path_name, data=None):
+        self.openSVG(file_path_name, data)
         self.updateOpenedSVG()
 
 
@@ -491,14 +820,14 @@ class laveqed_gui(object):
         # Avoids slugginess caused by zooming too much by accident
         if self.displayScale < 5:
             self.displayScale *= 1.05
-            self.updateOpenedSVG()
+            self.updateOpenedSVG(fast=True)
 
     def ZoomOutSVG(self, event=None):
         # Avoid problems with too small image
         self.displayScale /= 1.05
         if self.displayScale < 0.05:
             self.displayScale = 0.05
-        self.updateOpenedSVG()
+        self.updateOpenedSVG(fast=True)
 
     def ZoomResetSVG(self, event=None):
         self.displayScale = 1
@@ -506,6 +835,6 @@ class laveqed_gui(object):
 
 
 if __name__ == '__main__':
-    tmp=laveqed_gui(TITLE).run()
+    tmp=laveqed_gui(TITLE,measure='--startup-time' in sys.argv).run()
 
 
@@ -1,13 +1,21 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
-import subprocess, sys
-from xml.dom import minidom
+import subprocess, sys, os, re, shutil, hashlib, glob, json, tempfile, time, logging, itertools
+from collections import OrderedDict
+from contextlib import contextmanager
+from xml.etree.ElementTree import iterparse
+from xml.sax.saxutils import escape
+
+log=logging.getLogger('laveqed')
+log.addHandler(logging.NullHandler())
+_listeners=[]
+_tmpCount=itertools.count()
 
 
 
 class laveqed():
 
-    def __init__(self,equation='',name='laveqed', scale=4, cleanAfter=True, eqonly=False):
+    def __init__(self,equation='',name='laveqed', scale=4, cleanAfter=True, eqonly=False, cache=True, precompile=True, validate=True):
         self.preamble= '% Created by laveqed (%NOW%)\n'\
                        '\\documentclass{article}\n'\
                        '\\usepackage{amssymb,amsmath,xcolor}\n'\
@@ -26,35 +34,135 @@ class laveqed():
         else:
             self.cleanAfter=bool(cleanAfter)
         self.eqonly=eqonly
+        self.cache=cache    # True -> default RenderCache, False/None -> no cache
+        self.precompile=precompile  # Loads the preamble from a dumped format file
+        self.validate=validate  # Rejects obviously broken equations before running latex
+        self.workdir=None   # Scratch folder of the render in progress, see _base()
+        self.error=None     # Why makesvgs() couldn't render this one
+        self.cancelled=False    # Set by cancel()
+        self._proc=None     # latex or dvisvgm process running for this render
         self._tags=['LatexPreamble','LatexEquation','LatexPostamble','svgScale']
 
    
     def makesvg(self):
-        # Handling name/filename
-        basename=self.name
-        # Base command that generates a .dvi and converts it to svg with as scale factor
-        command = 'latex -interaction=batchmode \
-                   {basename}.tex\
-                   && dvisvgm --exact -c {scale},{scale} -n {basename}.dvi'
-        if self.cleanAfter: # Removes the files LaTeX spits out if cleanAfter is True
-            command=command+'&& rm {basename}.aux {basename}.log {basename}.dvi {basename}.tex'
-        # Puts real basename and scale values in the command
-        composed_command=command.format(basename = basename, scale = self.scale)
-        self._maketex() # Makes the tex file for compiling
-        subprocess.call(composed_command,shell=True) # Executes the shell command
-        self._commentSVG()  # Adds metadata to the svg so it can be loaded in the futre
+        # Only name.svg is written outside of the render's own scratch folder
+        self.timings=OrderedDict()  # Seconds spent in each stage of the last render
+        with self._stage('render') as info:
+            if self.validate:
+                with self._stage('check'):
+                    self.check()
+            self.workdir=_workspace()
+            try:
+                info['cached']=self._makesvg()
+            finally:
+                with self._stage('cleanup'):
+                    self._closeWorkspace()
+            info['bytes']=os.path.getsize(self.name+'.svg')
+
+    def _makesvg(self):
+        # Returns True if the svg came from the cache
+        # Identical renders are copied from the cache instead of recompiled
+        cache=self._getCache()
+        if cache is not None:
+            key=cache.key(self)
+            with self._stage('cache') as info:
+                info['hit']=cache.fetch(key,self.name+'.svg')
+            if info['hit']:
+                return True
+        # Generates a .dvi, unless latex already did for another scale
+        dvicache=self._getCache('.dvi')
+        with self._stage('dvicache') as info:
+            info['hit']=dvicache is not None and dvicache.fetch(dvicache.key(self),self._base()+'.dvi')
+        if not info['hit']:
+            with self._stage('format'):
+                fmt=self._getFormat()   # Precompiled preamble, if any
+            with self._stage('maketex'):
+                self._maketex(fmt) # Makes the tex file for compiling
+            with self._stage('latex') as info:
+                ret=info['returncode']=self._latex(fmt)
+            if ret:
+                self._checkCancelled()  # latex was terminated, not wrong
+                raise LatexError(parseLog(self._base()+'.log',self._equationOffset(fmt),\
+                        self.equation.count('\n')+1),ret)
+            if dvicache is not None:
+                dvicache.store(dvicache.key(self),self._base()+'.dvi')
+        # Converts it to svg with as scale factor, metadata included
+        with self._stage('dvisvgm') as info:
+            ret=info['returncode']=self._dvisvgm()
+        if ret:
+            self._checkCancelled()
+            raise subprocess.CalledProcessError(ret,'dvisvgm')
+        if cache is not None:
+            with self._stage('store'):
+                cache.store(key,self.name+'.svg')
+        return False
+
+    def check(self):
+        # Raises LatexError if the equation can't possibly compile
+        errors=checkEquation(self.equation,self.preamble)
+        if errors:
+            raise LatexError(errors)
+
+    @contextmanager
+    def _stage(self,stage,**info):
+        # Times the block into self.timings and emits it as a 'stage' event; the
+        # block can add to the event through the yielded dict.
+        if stage!='cleanup':
+            self._checkCancelled()
+        start=time.time()
+        try:
+            yield info
+        except Exception as e:
+            info['error']=str(e)
+            raise
+        finally:
+            duration=time.time()-start
+            self.timings[stage]=self.timings.get(stage,0)+duration
+            emit('stage',stage=stage,render=self.name,start=start,duration=duration,**info)
+
+    def cancel(self):
+        # Stops the render in progress, from another thread: the running latex
+        # or dvisvgm is terminated and the stages left raise Cancelled
+        self.cancelled=True
+        _terminate(self._proc)
+
+    def _checkCancelled(self):
+        if self.cancelled:
+            raise Cancelled('Render of {} cancelled'.format(self.name))
+
+    def _track(self,proc):
+        # Keeps proc for cancel(), None once it's done
+        self._proc=proc
+        if self.cancelled:
+            _terminate(proc)
+
+    def makesvg_async(self, timeout=None):
+        # Coroutine doing what makesvg does without blocking the event loop (Python 3)
+        from laveqed_async import makesvg_async
+        return makesvg_async(self,timeout)
+
+    def makesvg_incremental(self):
+        # makesvg for long align* blocks, reusing the rows that didn't change
+        from laveqed_rows import makesvg_incremental
+        return makesvg_incremental(self)
+
+    @staticmethod
+    def render_many_async(eqs, concurrency=8, timeout=None):
+        # Coroutine rendering many laveqed objects, at most concurrency at once
+        from laveqed_async import render_many_async
+        return render_many_async(eqs,concurrency,timeout)
 
     def loadsvg(self,filename):
         # Handling filename
         if not filename[-4:]=='.svg':
             filename=filename+'.svg'
-        # Loads and parses the svg xml file
-        xmlsvg=minidom.parse(filename)
-        tmp=xmlsvg.getElementsByTagName('desc')[0].childNodes # List of child nodes of desc
+        # Reads the metadata out of the svg xml file
+        meta=readMetadata(filename)
         if self.eqonly:  # Only loads the equation, not the -ambles
-            self.equation=tmp[1].firstChild.nodeValue
+            self.equation=meta['equation']
         else:       # Loads the whole LaTeX "document"
-            self.preamble,self.equation,self.postamble,self.scale=[i.firstChild.nodeValue for i in tmp]
+            self.preamble,self.equation,self.postamble,self.scale=\
+                    [meta[i] for i in ['preamble','equation','postamble','scale']]
             self.scale=int(self.scale)
         self.name=filename.replace('.svg','') # No error? -> Update the name of the object
 
@@ -62,31 +170,117 @@ class laveqed():
     def display(self):
         print(self._getTexCode())   # Print the whole LaTeX "document"
 
-    def _maketex(self): # Generates the tex file to compile
-        with open(self.name+'.tex','w') as f:
-            f.write(self._getTexCode())
-
-    def _commentSVG(self):  # Adds metadata to the svg so it can be loaded in the futre
-        basename=self.name
-        # Parsing
-        svgname=basename+'.svg' # That's why we ensure there's no '.svg' in self.name
-        xmlsvg=minidom.parse(svgname)   # Loads and parses the svg xml file
-        svg=xmlsvg.documentElement  # Represent the svg Element in the xml code
-        # Creating text nodes
-        Nodes=[xmlsvg.createTextNode(i) for i in \
-                [self.preamble.replace('%NOW%', Now()),self.equation,self.postamble,str(self.scale)]]
-        # Creating elements
-        descElement=xmlsvg.createElementNS(None,'desc')
-        Elements=[xmlsvg.createElementNS(None,i) for i in self._tags]
-        # Appending respective text node to each LaTeX element and the formers to desc
-        for i,j in zip(Elements,Nodes):
-            i.appendChild(j)
-            descElement.appendChild(i)
-        # Appending the completed desc element to the svg element
-        svg.appendChild(descElement)
-        # Writing the modified svg xml to file
-        with open(svgname,'w') as f:
-            xmlsvg.writexml(f)
+    def _base(self):
+        # Path, without extension, of the files LaTeX and dvisvgm work on
+        if self.workdir:
+            return os.path.join(self.workdir,os.path.basename(self.name))
+        return self.name
+
+    def _closeWorkspace(self):
+        # Removes the scratch folder; its files are kept next to the svg if cleanAfter is False
+        if self.workdir:
+            _closeWorkspace(self.workdir,self._base(),None if self.cleanAfter else self.name)
+            self.workdir=None
+
+    def _equationOffset(self,fmt=None):
+        # Number of lines before the equation in the tex file
+        head=self.preamble.replace('%NOW%',Now())
+        if fmt:
+            head=head.partition('\\begin{document}')[2]
+        return head.count('\n')
+
+    def _maketex(self,fmt=None): # Generates the tex file to compile
+        code=self._getTexCode()
+        if fmt: # The format already holds everything before \begin{document}
+            code='\\begin{document}'+code.partition('\\begin{document}')[2]
+        with open(self._base()+'.tex','w') as f:
+            f.write(code)
+
+    def _latex(self,fmt=None):
+        return _call(self._latexCommand(fmt),owner=self)
+
+    def _latexCommand(self,fmt=None):
+        command=['latex','-interaction=batchmode',self._base()+'.tex']
+        if fmt:
+            command.insert(1,'-fmt='+fmt)
+        if self.workdir:
+            command.insert(1,'-output-directory='+self.workdir)
+        return command
+
+    def _dvisvgm(self):
+        # dvisvgm's output is spliced with the metadata into a temporary file,
+        # moved onto the svg only if dvisvgm succeeds
+        command=self._dvisvgmCommand(stdout=True)
+        svgname=self.name+'.svg'
+        tmp=_tmpName(svgname)
+        start=time.time()
+        try:
+            with tempfile.TemporaryFile() as messages:
+                proc=subprocess.Popen(command,stdout=subprocess.PIPE,stderr=messages)
+                self._track(proc)
+                try:
+                    with open(tmp,'wb') as f:
+                        _spliceDesc(proc.stdout,f,self._descXML())
+                except ValueError:  # Not a svg, dvisvgm failed
+                    pass
+                finally:
+                    proc.stdout.close()
+                    ret=proc.wait()
+                    self._track(None)
+                messages.seek(0)
+                _logOutput(command,messages.read(),ret,start)
+            if not ret:
+                os.rename(tmp,svgname)
+        finally:
+            _remove([tmp])
+        return ret
+
+    def _dvisvgmCommand(self,stdout=False):
+        command=['dvisvgm','--exact','-c','{0},{0}'.format(self.scale),'-n',self._base()+'.dvi']
+        if stdout:
+            command.insert(-1,'--stdout')
+        else:
+            command[-1:-1]=['-o',self._base()+'.svg']
+        return command
+
+    def _clean(self):
+        _remove([self._base()+i for i in ['.aux','.log','.dvi','.tex']])
+
+    def _getFormat(self):
+        # Path (without .fmt) of the dumped preamble, None if it can't be used
+        head,begin,body=self.preamble.partition('\\begin{document}')
+        if not self.precompile or not begin:
+            return None
+        return preambleFormat(head)
+
+    def _commentSVG(self,stream=None):  # Adds metadata to the svg so it can be loaded in the futre
+        # Copies the svg from stream (default: the svg file itself) to the svg
+        # file, splicing the desc element in front of the closing </svg> tag.
+        svgname=self.name+'.svg' # That's why we ensure there's no '.svg' in self.name
+        if stream is None:
+            with open(svgname,'rb') as f:
+                return self._commentSVG(f)
+        tmp=_tmpName(svgname)
+        try:
+            with open(tmp,'wb') as f:
+                _spliceDesc(stream,f,self._descXML())
+            os.rename(tmp,svgname)
+        finally:
+            _remove([tmp])
+
+    def _descXML(self):
+        # The desc element holding the LaTeX code, as utf-8 bytes
+        values=[self.preamble.replace('%NOW%', Now()),self.equation,self.postamble,str(self.scale)]
+        desc='<desc>'+''.join('<{0}>{1}</{0}>'.format(i,escape(j)) \
+                for i,j in zip(self._tags,values))+'</desc>'
+        return desc if isinstance(desc,bytes) else desc.encode('utf-8')
+
+    def _getCache(self,ext='.svg'):
+        if self.cache is True:
+            return defaultCache(ext)
+        if ext=='.svg':
+            return self.cache or None
+        return None # Custom svg caches come without a dvi cache
 
     def _getTexCode(self):
         # Returns a single string with the whole LaTeX "document"
@@ -94,6 +288,635 @@ class laveqed():
         return tmp
 
 
+# Renders many laveqed objects with a single latex and a single dvisvgm run per
+# distinct preamble/postamble/scale, one page per equation. Cached equations are
+# skipped. Returns the list of objects that could not be rendered.
+def makesvgs(eqs, name='laveqed_batch', cleanAfter=True):
+    groups={}
+    failed=[]
+    for eq in eqs:
+        if eq.validate:
+            try:
+                eq.check()  # A broken one would send its whole group down the slow path
+            except LatexError as e:
+                eq.error=e
+                failed.append(eq)
+                continue
+        cache=eq._getCache()
+        if cache is not None and cache.fetch(cache.key(eq),eq.name+'.svg'):
+            continue
+        groups.setdefault((eq.preamble,eq.postamble,str(eq.scale)),[]).append(eq)
+    for n,group in enumerate(groups.values()):
+        failed+=_makesvgsGroup(group,'{}-{}'.format(name,n),cleanAfter)
+    return failed
+
+
+def _makesvgsGroup(group, basename, cleanAfter):
+    first=group[0]
+    # The document is split around \begin{document} and \end{document}; what's
+    # left of the -ambles (e.g. \begin{align*}) wraps every page.
+    head,begin,envopen=first.preamble.partition('\\begin{document}')
+    envclose,end,tail=first.postamble.partition('\\end{document}')
+    if len(group)==1 or not begin or not end:
+        return _makesvgsEach(group)
+    fmt=first._getFormat()
+    if fmt:
+        head=''
+    pages=''.join(envopen+eq.equation+envclose+'\n\\clearpage\n' for eq in group)
+    work=_workspace()
+    base=os.path.join(work,os.path.basename(basename))
+    try:
+        with open(base+'.tex','w') as f:
+            f.write((head+begin).replace('%NOW%',Now())+pages+end+tail)
+        command=['latex','-interaction=batchmode','-output-directory='+work,base+'.tex']
+        if fmt:
+            command.insert(1,'-fmt='+fmt)
+        ret=_call(command)
+        if not ret:
+            ret=_call(['dvisvgm','--exact','-c','{0},{0}'.format(first.scale),'-n',\
+                    '-p','1-','-o',base+'-%p.svg',base+'.dvi'])
+        svgs=sorted(glob.glob(base+'-*.svg'),key=lambda i:int(i[len(base)+1:-4]))
+        if ret or len(svgs)!=len(group):
+            # A broken equation spoils the whole document, find it the slow way
+            return _makesvgsEach(group)
+        for svg,eq in zip(svgs,group):
+            with open(svg,'rb') as f:
+                eq._commentSVG(f)
+            cache=eq._getCache()
+            if cache is not None:
+                cache.store(cache.key(eq),eq.name+'.svg')
+        return []
+    finally:
+        _closeWorkspace(work,base,None if cleanAfter else basename)
+
+
+def _makesvgsEach(group):
+    failed=[]
+    for eq in group:
+        try:
+            eq.makesvg()
+        except Exception as e:
+            eq.error=e
+            failed.append(eq)
+    return failed
+
+
+class Cancelled(Exception):
+    # Raised by the render of a laveqed object whose cancel() was called
+    pass
+
+
+class LatexError(subprocess.CalledProcessError):
+    # Errors of an equation, a list of dicts (message, line of the equation or
+    # None, ...). returncode is None if it was rejected before running latex.
+
+    def __init__(self, errors, returncode=None):
+        subprocess.CalledProcessError.__init__(self,returncode,'latex')
+        self.errors=errors
+
+    def __str__(self):
+        if not self.errors:
+            return 'latex exited with code {}'.format(self.returncode)
+        return '; '.join(('line {}: '.format(i['line']) if i.get('line') else '')+i['message'] \
+                for i in self.errors)
+
+
+# Environments in which & is misplaced; unknown ones get the benefit of the doubt
+_NOALIGN=set(['document','equation','equation*','gather','gather*','multline','multline*',\
+        'displaymath','math'])
+# amsmath displays, which end with an error on an empty line
+_DISPLAY=set(['equation','equation*','align','align*','gather','gather*','multline','multline*',\
+        'flalign','flalign*','alignat','alignat*','displaymath'])
+_TOKENS=re.compile(r'\\(begin|end)\s*\{([^{}]*)\}|\\[a-zA-Z@]+|\\.|%.*|[{}&]')
+
+
+# Environments left open by the end of a preamble, e.g. ['document', 'align*']
+def _openEnvs(preamble):
+    envs=[]
+    for m in _TOKENS.finditer(preamble):
+        if m.group(1)=='begin':
+            envs.append(m.group(2))
+        elif m.group(1)=='end' and m.group(2) in envs:
+            del envs[len(envs)-1-envs[::-1].index(m.group(2)):]
+    return envs
+
+
+# Errors latex would surely stop on, found without running it: unbalanced
+# braces and environments, & outside of alignments and empty lines in
+# displays. Returns a list of dicts (line, message), lines counted from 1.
+def checkEquation(equation, preamble=''):
+    errors=[]
+    outer=_openEnvs(preamble)
+    stack=[]    # ('{' or environment name, line) opened in the equation
+    closed=[]   # Surrounding environments the equation ends (and usually reopens)
+    for n,line in enumerate(equation.split('\n'),1):
+        envs=outer+[i for i,j in stack if i!='{']
+        if not line.strip():
+            display=[i for i in envs if i in _DISPLAY]
+            if display:
+                errors.append(dict(line=n,message='Empty line inside {}'.format(display[-1])))
+            continue
+        for m in _TOKENS.finditer(line):
+            token,kind,name=m.group(0),m.group(1),m.group(2)
+            if kind=='begin' or token=='{':
+                stack.append((name or '{',n))
+            elif kind=='end' or token=='}':
+                opened=name or '{'
+                if stack and stack[-1][0]==opened:
+                    stack.pop()
+                    continue
+                if not stack and outer and outer[-1]==opened:
+                    closed.append(outer.pop())
+                    continue
+                if not stack:
+                    message='{} closes nothing'.format(token)
+                elif stack[-1][0]=='{':
+                    message='{} before the {{ of line {} is closed'.format(token,stack[-1][1])
+                else:
+                    message='{} ends \\begin{{{}}} of line {}'.format(token,*stack[-1])
+                errors.append(dict(line=n,message=message))
+                if stack and opened!='{' and stack[-1][0]!='{':
+                    stack.pop()
+            elif token=='&':
+                envs=outer+[i for i,j in stack if i!='{']
+                if not envs or envs[-1] in _NOALIGN:
+                    errors.append(dict(line=n,message='& outside of an alignment'))
+    for opened,n in stack:
+        if opened in closed:    # The postamble ends it
+            closed.remove(opened)
+            continue
+        errors.append(dict(line=n,message='Unclosed {}'.format('{' if opened=='{' \
+                else '\\begin{{{}}}'.format(opened))))
+    return errors
+
+
+# LaTeX's errors in a .log file, as a list of dicts (message, texline, line,
+# context). line is the line of the equation, texline-offset, or None if the
+# error isn't within its nlines lines.
+def parseLog(logname, offset=0, nlines=None):
+    try:
+        with open(logname,'rb') as f:
+            text=f.read().decode('utf-8','replace').split('\n')
+    except (IOError,OSError):
+        return []
+    errors=[]
+    for n,i in enumerate(text):
+        if not i.startswith('!'):
+            continue
+        error=dict(message=i[1:].strip(),texline=None,line=None,context='')
+        for j in text[n+1:n+20]:
+            m=re.match(r'l\.(\d+) (.*)',j)
+            if m:
+                error['texline']=int(m.group(1))
+                error['context']=m.group(2).strip()
+                line=error['texline']-offset
+                if 1<=line<=(nlines or line):
+                    error['line']=line
+                break
+        errors.append(error)
+    return errors
+
+
+# Reads the laveqed metadata (desc element) of a svg file without building the
+# whole document: glyphs are dropped as they are parsed and parsing stops as
+# soon as desc is complete. Returns a dict with the keys preamble, equation,
+# postamble and scale; raises ValueError if there's no metadata.
+_METADATA={'LatexPreamble':'preamble','LatexEquation':'equation',\
+           'LatexPostamble':'postamble','svgScale':'scale'}
+def readMetadata(filename):
+    depth=0
+    root=None
+    for event,elem in iterparse(filename,events=('start','end')):
+        tag=elem.tag.rpartition('}')[2]  # Drops the svg namespace
+        if event=='start':
+            if root is None:
+                root=elem
+            depth+=1
+            continue
+        depth-=1
+        if tag=='desc':
+            meta=dict((_METADATA[i.tag.rpartition('}')[2]],i.text or '') for i in elem \
+                    if i.tag.rpartition('}')[2] in _METADATA)
+            if len(meta)==len(_METADATA):
+                return meta
+        elif depth==1:  # Done with a child of <svg>, forget it
+            root.clear()
+    raise ValueError('No laveqed metadata in '+(filename if isinstance(filename,str) else 'the svg'))
+
+
+# Copies src to dst in chunks, inserting desc before the last </svg>. Only the
+# last few kB are held back, whatever the size of the svg.
+def _spliceDesc(src, dst, desc, chunk=2**16, hold=4096):
+    tail=b''
+    while True:
+        data=src.read(chunk)
+        if not data:
+            break
+        tail+=data
+        if len(tail)>hold:
+            dst.write(tail[:-hold])
+            tail=tail[-hold:]
+    i=tail.rfind(b'</svg>')
+    if i<0:
+        raise ValueError('Not a svg file: no closing </svg> tag')
+    dst.write(tail[:i]+desc+tail[i:])
+
+
+# Instrumentation: every listener is called with a dict for each event, from
+# the thread doing the work. Events are also logged (DEBUG) to 'laveqed'.
+#   stage:   stage, render, start, duration (s) and e.g. hit, returncode, bytes
+#   process: command, argv, returncode, start, duration
+#   cache:   kind ('.svg', '.dvi', ...), key, hit
+def addListener(callback):
+    _listeners.append(callback)
+
+
+def removeListener(callback):
+    _listeners.remove(callback)
+
+
+def emit(event, **info):
+    info['event']=event
+    log.debug('%r',info)
+    for i in list(_listeners):
+        i(info)
+
+
+def _call(command, owner=None, **kwargs):
+    # subprocess.call, with the output sent to the log instead of the terminal.
+    # owner: the laveqed object rendering, whose cancel() terminates the process.
+    start=time.time()
+    proc=subprocess.Popen(command,stdout=subprocess.PIPE,stderr=subprocess.STDOUT,**kwargs)
+    if owner is not None:
+        owner._track(proc)
+    try:
+        output=proc.communicate()[0]
+    finally:
+        if owner is not None:
+            owner._track(None)
+    _logOutput(command,output,proc.returncode,start)
+    return proc.returncode
+
+
+def _terminate(proc):
+    if proc is not None:
+        try:
+            proc.terminate()
+        except OSError:     # Already gone
+            pass
+
+
+def _logOutput(command, output, ret, start):
+    if output:
+        log.debug('%s: %s',command[0],output.decode('utf-8','replace').rstrip())
+    emit('process',command=command[0],argv=command,returncode=ret,start=start,duration=time.time()-start)
+
+
+# Folder holding the renders' scratch folders: $LAVEQED_TMPDIR, else /dev/shm
+# (RAM, no disk I/O for LaTeX's many small files), else the system's temp folder
+def scratchDir():
+    for i in [os.environ.get('LAVEQED_TMPDIR'),'/dev/shm']:
+        if i and os.path.isdir(i) and os.access(i,os.W_OK|os.X_OK):
+            return i
+    return tempfile.gettempdir()
+
+
+# New scratch folder for a render, unique even among concurrent ones
+def _workspace():
+    return tempfile.mkdtemp(prefix='laveqed-',dir=scratchDir())
+
+
+# Removes a scratch folder, first moving base's LaTeX files to keep (a path
+# without extension) unless keep is None
+def _closeWorkspace(work, base, keep=None):
+    if keep is not None:
+        for i in ['.tex','.aux','.log','.dvi']:
+            if os.path.isfile(base+i):
+                shutil.move(base+i,keep+i)
+    shutil.rmtree(work,ignore_errors=True)
+
+
+# Unique temporary name next to path, to write a file and rename it into place
+def _tmpName(path):
+    return '{}.{}-{}.tmp'.format(path,os.getpid(),next(_tmpCount))
+
+
+# utf-8 bytes of text, which Python 2 may hand over as bytes already (argv, files)
+def _utf8(text):
+    return text if isinstance(text,bytes) else text.encode('utf-8')
+
+
+def _remove(files):
+    for i in files:
+        try:
+            os.remove(i)
+        except OSError:
+            pass
+
+
+# Reads a list of equations to render. Each line is either JSON with the keys
+# equation, name and scale, or <equation>[<TAB><name>[<TAB><scale>]].
+# Unnamed equations are numbered after the file; JSON without an equation is
+# reported and skipped.
+def readManifest(filename):
+    base=os.path.splitext(os.path.basename(filename))[0]
+    jobs=[]
+    with open(filename) as f:
+        for n,line in enumerate(f,1):
+            line=line.rstrip('\r\n')
+            if not line.strip():
+                continue
+            job=None
+            if line.lstrip().startswith('{'):
+                try:
+                    job=json.loads(line)
+                except ValueError:  # An equation starting with {, e.g. {x+y}^2
+                    pass
+            if not isinstance(job,dict):
+                job=dict(zip(['equation','name','scale'],line.split('\t')))
+            elif 'equation' not in job:
+                sys.stderr.write('Skipping line {} of {}: no equation\n'.format(n,filename))
+                continue
+            job.setdefault('name','{}-{}'.format(base,len(jobs)+1))
+            job['name']=job['name'].replace('.svg','')
+            jobs.append(job)
+    return jobs
+
+
+def _fromJob(job):
+    eq=laveqed(job['equation'],name=job['name'])
+    for i in ['scale','preamble','postamble']:
+        if i in job:
+            setattr(eq,i,job[i])
+    return eq
+
+
+def _batch(filename):
+    eqs=[_fromJob(i) for i in readManifest(filename)]
+    failed=makesvgs(eqs,name=os.path.splitext(os.path.basename(filename))[0])
+    for eq in failed:
+        print('Error building {}.svg: {}'.format(eq.name,eq.error))
+    print('{} of {} equations rendered'.format(len(eqs)-len(failed),len(eqs)))
+    return 1 if failed else 0
+
+
+# Renders a manifest entry in its own scratch folder and moves the svg to
+# job['dest']. Returns (name, success, error message, seconds).
+def _renderJob(job):
+    start=time.time()
+    try:
+        eq=_fromJob(job)
+        eq.name=job['dest'][:-4]
+        eq.makesvg()
+        ok,error=True,None
+    except Exception as e:
+        ok,error=False,str(e)
+    return job['name'],ok,error,time.time()-start
+
+
+# Renders a manifest on a pool of n processes, reporting each job as it ends
+def _parallel(n, filename):
+    import multiprocessing
+    jobs=readManifest(filename)
+    for i in jobs:
+        i['dest']=os.path.abspath(i['name']+'.svg')
+    start=time.time()
+    failed=0
+    pool=multiprocessing.Pool(n)
+    try:
+        for name,ok,error,duration in pool.imap_unordered(_renderJob,jobs):
+            if ok:
+                print('Done\t{}.svg\t{:.2f}s'.format(name,duration))
+            else:
+                failed+=1
+                print('Failed\t{}.svg\t{}'.format(name,error))
+    finally:
+        pool.close()
+        pool.join()
+    duration=time.time()-start
+    print('{} of {} equations rendered in {:.2f}s ({:.1f} equations/s)'.format(\
+            len(jobs)-failed,len(jobs),duration,len(jobs)/max(duration,1e-9)))
+    return 1 if failed else 0
+
+
+def _extractOne(filename):
+    try:
+        meta=readMetadata(filename)
+    except Exception as e:
+        return filename,None,str(e)
+    meta['path']=filename
+    return filename,meta,None
+
+
+# Prints the metadata of every laveqed svg under folder as JSON lines
+def _extract(folder):
+    import multiprocessing
+    def svgs():
+        for path,dirs,files in os.walk(folder):
+            for i in sorted(files):
+                if i.endswith('.svg'):
+                    yield os.path.join(path,i)
+    pool=multiprocessing.Pool()
+    try:
+        for filename,meta,error in pool.imap(_extractOne,svgs(),64):
+            if meta is None:
+                sys.stderr.write('Skipping {}: {}\n'.format(filename,error))
+            else:
+                print(json.dumps(meta,sort_keys=True))
+    finally:
+        pool.close()
+        pool.join()
+    return 0
+
+
+class RenderCache(object):
+    # On-disk cache of finished svgs (metadata included), evicted in LRU order
+    # once the stored files exceed maxsize bytes. With ext='.dvi' it holds the
+    # output of latex instead, keyed without the scale.
+
+    def __init__(self, path=None, maxsize=256*2**20, ext='.svg'):
+        self.path=path or _cacheDir(ext[1:])
+        self.maxsize=maxsize
+        self.ext=ext
+        self.hits=0
+        self.misses=0
+        self._size=None # Estimate of the bytes stored, see store()
+
+    def key(self,eq):
+        # Hash of the TeX source (without the %NOW% timestamp), scale and tools
+        h=hashlib.sha1()
+        scale=str(eq.scale) if self.ext=='.svg' else ''
+        for i in [eq.preamble.replace('%NOW%',''),eq.equation,eq.postamble,\
+                scale,_toolVersions()]:
+            h.update(_utf8(i)+b'\0')
+        return h.hexdigest()
+
+    def fetch(self,key,dest):
+        # Copies the cached file to dest; returns False on a miss
+        path=os.path.join(self.path,key+self.ext)
+        tmp=_tmpName(dest)
+        try:
+            shutil.copyfile(path,tmp)
+            os.rename(tmp,dest)
+            os.utime(path,None) # Marks the entry as recently used
+        except (IOError,OSError):
+            _remove([tmp])
+            self.misses+=1
+            emit('cache',kind=self.ext,key=key,hit=False)
+            return False
+        self.hits+=1
+        emit('cache',kind=self.ext,key=key,hit=True)
+        return True
+
+    def store(self,key,src):
+        path=os.path.join(self.path,key+self.ext)
+        tmp=_tmpName(path)
+        try:
+            shutil.copyfile(src,tmp)
+            os.rename(tmp,path)   # Atomic, concurrent renders never see half a file
+            size=os.path.getsize(path)
+        except (IOError,OSError):
+            return
+        # The folder is only listed once the estimate goes over maxsize; the
+        # estimate doesn't see other processes' stores, evict() recounts them
+        if self._size is None:
+            self.evict()
+        else:
+            self._size+=size
+            if self._size>self.maxsize:
+                self.evict()
+
+    def evict(self):
+        # Removes least recently used entries until the cache fits in 90% of
+        # maxsize, so that a full cache isn't listed again on every store
+        entries=[]
+        for i in os.listdir(self.path):
+            try:
+                st=os.stat(os.path.join(self.path,i))
+            except OSError:
+                continue
+            entries.append((st.st_mtime,st.st_size,i))
+        total=sum(i[1] for i in entries)
+        if total>self.maxsize:
+            for mtime,size,i in sorted(entries):
+                if total<=.9*self.maxsize:
+                    break
+                try:
+                    os.remove(os.path.join(self.path,i))
+                    total-=size
+                except OSError:
+                    pass
+        self._size=total
+
+    def clear(self):
+        for i in os.listdir(self.path):
+            try: os.remove(os.path.join(self.path,i))
+            except OSError: pass
+        self._size=0
+
+    def stats(self):
+        files=[os.path.join(self.path,i) for i in os.listdir(self.path)]
+        return dict(hits=self.hits, misses=self.misses, entries=len(files),\
+                size=sum(os.path.getsize(i) for i in files if os.path.isfile(i)))
+
+
+# Returns the path (without .fmt) of a format file with the given LaTeX code
+# (everything before \begin{document}) dumped in it, building it if needed.
+# Formats are keyed on the code and the TeX installation so they are rebuilt
+# when either changes. Returns None if the preamble can't be dumped.
+_failedFormats=set()
+def preambleFormat(header):
+    header=header.replace('%NOW%','')
+    h=hashlib.sha1(_utf8(header))
+    h.update(_utf8(_texInstallID()))
+    key=h.hexdigest()
+    fmtdir=_cacheDir('fmt')
+    path=os.path.join(fmtdir,key)
+    if os.path.isfile(path+'.fmt'):
+        return path
+    if key in _failedFormats:
+        return None
+    # Concurrent builds, from other processes or threads, don't step on each other
+    tmp='{}-{}-{}'.format(key,os.getpid(),next(_tmpCount))
+    with open(os.path.join(fmtdir,tmp+'.tex'),'w') as f:
+        f.write(header+'\n\\dump\n')
+    try:
+        ret=_call(['latex','-ini','-interaction=batchmode','-output-directory='+fmtdir,\
+                '-jobname='+tmp,'&latex',os.path.join(fmtdir,tmp+'.tex')])
+        if ret:
+            raise OSError
+        os.rename(os.path.join(fmtdir,tmp+'.fmt'),path+'.fmt')
+    except OSError:
+        _failedFormats.add(key)
+        path=None
+    finally:
+        _remove([os.path.join(fmtdir,tmp+i) for i in ['.tex','.log','.aux','.fmt']])
+    return path
+
+
+# Identifies the TeX installation: binaries and the base latex format, which
+# is regenerated whenever packages are updated
+_texID=None
+def _texInstallID():
+    global _texID
+    if _texID is None:
+        _texID=_toolVersions()
+        try:
+            with open(os.devnull,'w') as devnull:
+                fmt=subprocess.check_output(['kpsewhich','-engine=pdftex','latex.fmt'],\
+                        stderr=devnull).decode().strip()
+            _texID+=';{}:{}'.format(fmt,int(os.stat(fmt).st_mtime))
+        except (OSError,subprocess.CalledProcessError):
+            pass
+    return _texID
+
+
+_defaultCaches={}
+def defaultCache(ext='.svg'):
+    if ext not in _defaultCaches:
+        _defaultCaches[ext]=RenderCache(ext=ext)
+    return _defaultCaches[ext]
+
+
+# Returns (and creates) a folder in the per-user laveqed cache
+def _cacheDir(sub=''):
+    base=os.environ.get('LAVEQED_CACHE') or os.path.join(os.environ.get('XDG_CACHE_HOME') \
+            or os.path.expanduser(os.path.join('~','.cache')),'laveqed')
+    path=os.path.join(base,sub)
+    if not os.path.isdir(path):
+        try:
+            os.makedirs(path)
+        except OSError:
+            pass    # Created by a concurrent render
+    return path
+
+
+# Returns the full path of an executable found in PATH, None otherwise
+def _which(program):
+    for i in os.environ.get('PATH','').split(os.pathsep):
+        path=os.path.join(i,program)
+        if os.path.isfile(path) and os.access(path,os.X_OK):
+            return path
+    return None
+
+
+# Identifies the installed latex and dvisvgm so an upgrade invalidates the cache
+_toolsID=None
+def _toolVersions():
+    global _toolsID
+    if _toolsID is None:
+        ids=[]
+        for i in ['latex','dvisvgm']:
+            path=_which(i)
+            if path is None:
+                ids.append(i+':none')
+            else:
+                st=os.stat(path)
+                ids.append('{}:{}:{}'.format(path,st.st_size,int(st.st_mtime)))
+        _toolsID=';'.join(ids)
+    return _toolsID
+
+
 # Prints usage of laveqed
 def  _printUsage():
         usage = '\nlaveqed (LaTeX Vectorial Equation Editor) - Jos (2014)\n'\
@@ -101,10 +924,31 @@ def  _printUsage():
                 '\n  -Creating a svg:'\
                 '\n    laveqed "<equation>" [<filename>, <scale>, ...] \n'\
                 '\n  -Reading a svg:\n    laveqed <filename.svg>\n'\
+                '\n  -Creating many svgs with a single LaTeX run:'\
+                '\n    laveqed --batch <equations.txt>\n'\
+                '\n  -Creating many svgs on N processes:'\
+                '\n    laveqed --jobs N <equations.txt>\n'\
+                '\n  -Listing the equations of every svg in a folder (JSON lines):'\
+                '\n    laveqed --extract <folder>\n'\
+                '\n  -Indexing the svgs of a folder and searching the index:'\
+                '\n    laveqed --index <folder>'\
+                '\n    laveqed --search <text>'\
+                '\n    laveqed --search-regex <regex>'\
+                '\n    laveqed --duplicates\n'\
+                '\n  -Serving renders to local clients over HTTP (default port 8765):'\
+                '\n    laveqed --serve [<port>|<host:port>|<socket path>]\n'\
+                '\n  -Sharing the glyphs of many svgs in one sprite file, rounding numbers:'\
+                '\n    laveqed --optimize [--precision N] [--sprite glyphs.svg] <file.svg|folder> ...\n'\
+                '\n  -Rasterizing svgs (files, folders or equation lists) to png:'\
+                '\n    laveqed --png [--dpi N] <file.svg|folder|equations.txt> ...\n'\
                 '\n e.g.\n    laveqed "F=ma"\t\t-> Create svg file named as current time'\
                 '\n    laveqed "F=ma" Newton.svg\t-> Create Newton.svg'\
                 '\n    laveqed "F=ma" Newton 10\t-> Create Newton.svg with scale 10'\
-                '\n    laveqed Newton.svg\t\t-> Read Newton.svg; output "F=ma"\n'
+                '\n    laveqed Newton.svg\t\t-> Read Newton.svg; output "F=ma"\n'\
+                '\nRenders are cached in ~/.cache/laveqed (or $LAVEQED_CACHE).'\
+                '\nLaTeX runs in a scratch folder under /dev/shm (or $LAVEQED_TMPDIR).'\
+                '\nSet $LAVEQED_TRACE=<trace.json> to write a Chrome trace of the run, or'\
+                '\n$LAVEQED_EVENTS=<events.jsonl> (- for stderr) to log every timing event.\n'
         print(usage)
 
 
@@ -119,7 +963,35 @@ def Now(HMS=True):
 
 
 if __name__ == '__main__':
-    if len(sys.argv) == 2 and sys.argv[1][-4:]=='.svg':
+    sys.modules.setdefault('laveqed',sys.modules[__name__])   # Helpers share this module's listeners and caches
+    if os.environ.get('LAVEQED_TRACE') or os.environ.get('LAVEQED_EVENTS'):
+        from laveqed_trace import fromEnvironment
+        fromEnvironment()
+    if len(sys.argv) == 3 and sys.argv[1]=='--batch':
+        sys.exit(_batch(sys.argv[2]))
+    elif len(sys.argv) == 3 and sys.argv[1]=='--extract':
+        sys.exit(_extract(sys.argv[2]))
+    elif len(sys.argv) == 3 and sys.argv[1]=='--index':
+        from laveqed_index import _index
+        sys.exit(_index(sys.argv[2]))
+    elif len(sys.argv) == 3 and sys.argv[1] in ['--search','--search-regex']:
+        from laveqed_index import _search
+        sys.exit(_search(sys.argv[2],regexp=sys.argv[1]=='--search-regex'))
+    elif len(sys.argv) == 2 and sys.argv[1]=='--duplicates':
+        from laveqed_index import _duplicates
+        sys.exit(_duplicates())
+    elif len(sys.argv) >= 3 and sys.argv[1]=='--png':
+        from laveqed_png import _png
+        sys.exit(_png(sys.argv[2:]))
+    elif len(sys.argv) in [2,3] and sys.argv[1]=='--serve':
+        from laveqed_server import _serve
+        sys.exit(_serve(sys.argv[2:]))
+    elif len(sys.argv) >= 3 and sys.argv[1]=='--optimize':
+        from laveqed_optimize import _optimize
+        sys.exit(_optimize(sys.argv[2:]))
+    elif len(sys.argv) == 4 and sys.argv[1]=='--jobs':
+        sys.exit(_parallel(int(sys.argv[2]),sys.argv[3]))
+    elif len(sys.argv) == 2 and sys.argv[1][-4:]=='.svg':
         a=laveqed(eqonly=True)
         try:
             a.loadsvg(sys.argv[1])
@@ -0,0 +1,63 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# asyncio rendering for laveqed (Python 3 only), reached through
+# laveqed.makesvg_async() and laveqed.render_many_async()
+import asyncio, subprocess
+from laveqed import _workspace, LatexError, parseLog
+
+
+async def _run(command):
+    # Runs command without a shell, killing it on cancellation (timeouts
+    # included). Returns its exit code.
+    proc=await asyncio.create_subprocess_exec(*command,\
+            stdout=subprocess.DEVNULL,stderr=subprocess.DEVNULL)
+    try:
+        ret=await proc.wait()
+    except BaseException:   # CancelledError
+        if proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+        raise
+    return ret
+
+
+async def makesvg_async(eq, timeout=None):
+    # timeout applies to the whole render, format build included
+    await asyncio.wait_for(_makesvg(eq),timeout)
+
+
+async def _makesvg(eq):
+    if eq.validate:
+        eq.check()
+    cache=eq._getCache()
+    if cache is not None:
+        key=cache.key(eq)
+        if cache.fetch(key,eq.name+'.svg'):
+            return
+    loop=asyncio.get_running_loop()
+    fmt=await loop.run_in_executor(None,eq._getFormat) # May have to build it
+    eq.workdir=_workspace()
+    try:
+        eq._maketex(fmt)
+        ret=await _run(eq._latexCommand(fmt))
+        if ret:     # The same errors as makesvg, read from the log
+            raise LatexError(parseLog(eq._base()+'.log',eq._equationOffset(fmt),\
+                    eq.equation.count('\n')+1),ret)
+        ret=await _run(eq._dvisvgmCommand())
+        if ret:
+            raise subprocess.CalledProcessError(ret,'dvisvgm')
+        with open(eq._base()+'.svg','rb') as f:
+            eq._commentSVG(f)
+    finally:
+        eq._closeWorkspace()
+    if cache is not None:
+        cache.store(key,eq.name+'.svg')
+
+
+async def render_many_async(eqs, concurrency=8, timeout=None):
+    # Returns one entry per equation: None on success, the exception otherwise
+    semaphore=asyncio.Semaphore(concurrency)
+    async def render(eq):
+        async with semaphore:
+            await makesvg_async(eq,timeout)
+    return await asyncio.gather(*[render(i) for i in eqs],return_exceptions=True)
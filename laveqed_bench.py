@@ -0,0 +1,142 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# Benchmark of the rendering pipeline on a fixed corpus of equations. The
+# stages of makesvg are timed as it runs them (laveqed.timings, caches off),
+# along with loadsvg and the GUI's rasterization, and the results are written
+# as JSON to compare commits.
+#
+# Usage:
+#   python laveqed_bench.py [-n REPEAT] [-o results.json] [--compare old.json]
+import os, sys, time, json, shutil, tempfile, subprocess
+from laveqed import laveqed, Now
+
+CORPUS={
+    'short': r'F=ma',
+    'long': r'\int_{-\infty}^{\infty} e^{-\frac{(x-\mu)^2}{2\sigma^2}}\,dx'
+            r'=\sigma\sqrt{2\pi}=\sum_{n=0}^{\infty}\frac{(-1)^n}{n!}\left(\frac{a+b}{c+d}\right)^{2n}'
+            r'+\prod_{k=1}^{N}\left(1-\frac{1}{p_k^s}\right)^{-1}+\lim_{h\to0}\frac{f(x+h)-f(x)}{h}',
+    'align': r'\nabla\cdot\mathbf{E} &= \frac{\rho}{\varepsilon_0} \\'
+             '\n'r'\nabla\cdot\mathbf{B} &= 0 \\'
+             '\n'r'\nabla\times\mathbf{E} &= -\frac{\partial\mathbf{B}}{\partial t} \\'
+             '\n'r'\nabla\times\mathbf{B} &= \mu_0\mathbf{J}+\mu_0\varepsilon_0\frac{\partial\mathbf{E}}{\partial t}',
+    'color': r'\text{L\hspace{-3.5pt}\raisebox{2pt}{\scriptsize A}\!}{\color{gray!68}\text{\TeX}}'
+             r'\text{ V{\color{gray!80}ectorial} Eq{\color{gray!80}uation} Ed{\color{gray!80}itor}}',
+}
+
+STAGES=['check','format','maketex','latex','dvisvgm','cleanup','render','loadsvg','rasterize']
+USAGE='Usage: python laveqed_bench.py [-n REPEAT] [-o results.json] [--compare old.json]'
+THRESHOLD=1.10    # Slower than this ratio is a regression...
+MINDELTA=0.001      # ...if it also lost at least that many seconds (timer noise)
+
+
+def _timed(times,stage,function,*args,**kwargs):
+    start=time.time()
+    result=function(*args,**kwargs)
+    times.setdefault(stage,[]).append(time.time()-start)
+    return result
+
+
+def _rasterize(filename):
+    import cairo,rsvg
+    with rsvg.Handle(path=filename) as svg:
+        surface=svg.render_surface(1)
+        surface.get_data()
+
+
+def bench(name,equation,repeat):
+    # Returns {stage: [seconds, ...]} for one equation of the corpus
+    try:
+        import cairo,rsvg
+        raster=True
+    except (ImportError,OSError,AttributeError):  # No librsvg/pycairo, skip that stage
+        raster=False
+    times={}
+    for i in range(repeat):
+        eq=laveqed(equation,name=name,cache=False)
+        try:
+            eq.makesvg()
+        except Exception as e:
+            raise RuntimeError('{} failed: {}'.format(name,e))
+        for stage,seconds in eq.timings.items():
+            times.setdefault(stage,[]).append(seconds)
+        _timed(times,'loadsvg',laveqed().loadsvg,name+'.svg')
+        if raster:
+            _timed(times,'rasterize',_rasterize,name+'.svg')
+    return times
+
+
+def _summary(values):
+    values=sorted(values)
+    return dict(min=values[0],median=values[len(values)//2],mean=sum(values)/len(values),n=len(values))
+
+
+def _commit():
+    try:
+        with open(os.devnull,'w') as devnull:
+            return subprocess.check_output(['git','rev-parse','HEAD'],stderr=devnull,\
+                    cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError,subprocess.CalledProcessError):
+        return None
+
+
+def run(repeat=5):
+    owd=os.getcwd()
+    cwd=tempfile.mkdtemp(prefix='laveqed-bench-')
+    results={}
+    try:
+        os.chdir(cwd)
+        for name in sorted(CORPUS):
+            times=bench(name,CORPUS[name],repeat)
+            results[name]=dict((i,_summary(times[i])) for i in STAGES if i in times)
+    finally:
+        os.chdir(owd)
+        shutil.rmtree(cwd,ignore_errors=True)
+    return dict(commit=_commit(),date=Now(),python=sys.version.split()[0],repeat=repeat,results=results)
+
+
+def compare(old,new):
+    # Prints the median of each stage, old vs new; returns the number of regressions
+    regressions=0
+    for name in sorted(new['results']):
+        for stage in STAGES:
+            if stage not in new['results'][name] or stage not in old['results'].get(name,{}):
+                continue
+            a=old['results'][name][stage]['median']
+            b=new['results'][name][stage]['median']
+            ratio=b/a if a else 1
+            flag=''
+            if ratio>THRESHOLD and b-a>MINDELTA:
+                flag='  <- regression'
+                regressions+=1
+            print('{:8s}{:12s}{:10.2f} ms{:10.2f} ms{:8.2f}x{}'.format(name,stage,1000*a,1000*b,ratio,flag))
+    return regressions
+
+
+def _main(args):
+    repeat,output,old=5,None,None
+    while args:
+        if len(args)<2 or args[0] not in ['-n','-o','--compare']:
+            sys.stderr.write(USAGE+'\n')
+            return 2
+        option,value,args=args[0],args[1],args[2:]
+        if option=='-n':
+            repeat=int(value)
+        elif option=='-o':
+            output=value
+        elif option=='--compare':
+            with open(value) as f:
+                old=json.load(f)
+    results=run(repeat)
+    text=json.dumps(results,indent=2,sort_keys=True)
+    if output:
+        with open(output,'w') as f:
+            f.write(text)
+    else:
+        print(text)
+    if old is not None:
+        return 1 if compare(old,results) else 0
+    return 0
+
+
+if __name__=='__main__':
+    sys.exit(_main(sys.argv[1:]))
@@ -0,0 +1,115 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# SQLite index of laveqed svgs: path, equation, preamble hash, scale and mtime
+# of every file, kept up to date incrementally from the files' mtimes.
+import os, re, sys, sqlite3, hashlib
+from laveqed import _extractOne, _cacheDir
+
+_SCHEMA = 'CREATE TABLE IF NOT EXISTS equations ('\
+          'path TEXT PRIMARY KEY, equation TEXT, preamble_hash TEXT, '\
+          'scale TEXT, mtime REAL);'\
+          'CREATE INDEX IF NOT EXISTS equations_dup ON equations (equation, preamble_hash, scale);'
+
+
+# Hash of a preamble, ignoring the creation date laveqed writes in it
+def preambleHash(preamble):
+    preamble=re.sub(r'% Created by laveqed \(.*\)','',preamble)
+    return hashlib.sha1(preamble.encode('utf-8')).hexdigest()
+
+
+def _regexp(pattern, text):
+    return text is not None and re.search(pattern,text) is not None
+
+
+class EquationIndex(object):
+
+    def __init__(self, path=None):
+        self.path=path or os.environ.get('LAVEQED_INDEX') or os.path.join(_cacheDir(),'index.sqlite')
+        self.db=sqlite3.connect(self.path)
+        self.db.executescript(_SCHEMA)
+        self.db.create_function('REGEXP',2,_regexp)
+
+    def update(self, folder):
+        # (Re)reads the svgs under folder that changed since the last update and
+        # forgets the ones that are gone. Returns (#updated, #removed).
+        folder=os.path.abspath(folder)
+        prefix=folder.rstrip(os.sep)+os.sep
+        known=dict(self.db.execute('SELECT path, mtime FROM equations WHERE substr(path,1,?)=?',\
+                (len(prefix),prefix)))
+        found={}
+        for path,dirs,files in os.walk(folder):
+            for i in files:
+                if i.endswith('.svg'):
+                    filename=os.path.join(path,i)
+                    found[filename]=os.path.getmtime(filename)
+        changed=[i for i in found if known.get(i)!=found[i]]
+        removed=[i for i in known if i not in found]
+        rows=[]
+        for filename,meta,error in _map(_extractOne,changed):
+            if meta is None:    # Not a laveqed svg, remember it anyway so it's not reread
+                rows.append((filename,None,None,None,found[filename]))
+            else:
+                rows.append((filename,meta['equation'],preambleHash(meta['preamble']),\
+                        meta['scale'],found[filename]))
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO equations VALUES (?,?,?,?,?)',rows)
+            self.db.executemany('DELETE FROM equations WHERE path=?',[(i,) for i in removed])
+        return len(rows),len(removed)
+
+    def search(self, pattern, regexp=False):
+        # Returns (path, equation) of every equation containing pattern. A bad
+        # regular expression raises re.error here, not from inside SQLite.
+        if regexp:
+            re.compile(pattern)
+            query='SELECT path, equation FROM equations WHERE equation REGEXP ? ORDER BY path'
+        else:
+            query='SELECT path, equation FROM equations WHERE instr(equation, ?) ORDER BY path'
+        return self.db.execute(query,(pattern,)).fetchall()
+
+    def duplicates(self):
+        # Returns lists of paths having the same equation, preamble and scale
+        query='SELECT group_concat(path, ?) FROM equations WHERE equation IS NOT NULL '\
+              'GROUP BY equation, preamble_hash, scale HAVING count(*)>1'
+        return [i[0].split('\n') for i in self.db.execute(query,('\n',))]
+
+    def close(self):
+        self.db.close()
+
+
+def _map(function, items):
+    # Reads many files on a process pool, few of them directly
+    if len(items)<64:
+        return [function(i) for i in items]
+    import multiprocessing
+    pool=multiprocessing.Pool()
+    try:
+        return pool.map(function,items,64)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _index(folder):
+    index=EquationIndex()
+    updated,removed=index.update(folder)
+    print('{} svgs updated, {} removed in {}'.format(updated,removed,index.path))
+    return 0
+
+
+def _search(pattern, regexp=False):
+    index=EquationIndex()
+    try:
+        results=index.search(pattern,regexp)
+    except re.error as e:
+        sys.stderr.write('Invalid regular expression {!r}: {}\n'.format(pattern,e))
+        return 2
+    for path,equation in results:
+        print(path+'\t'+equation.replace('\n',' '))
+    return 0
+
+
+def _duplicates():
+    index=EquationIndex()
+    for paths in index.duplicates():
+        print('\t'.join(paths))
+    return 0
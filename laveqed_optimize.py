@@ -0,0 +1,154 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# Output optimization for sets of equations, e.g. after laveqed --batch: the
+# glyph outlines dvisvgm copies into every svg are moved to one shared sprite
+# file that the svgs reference, numbers are rounded to a given precision and
+# path data is minified. The desc metadata is left as is, loadsvg still works.
+#
+#   laveqed --optimize [--precision N] [--sprite glyphs.svg] <file.svg|folder> ...
+#
+# Glyph ids are a hash of their outline and a sprite already in the folder is
+# merged, never replaced: svgs optimized by an earlier run keep their glyphs.
+#
+# Browsers only follow references to another file when the svgs are inlined in
+# the page or loaded with <object>, not with <img>; --sprite '' references the
+# glyphs as #ids instead, for pages that inline the sprite themselves.
+import os, re, hashlib
+from laveqed import _tmpName
+
+_DEFS=re.compile(r'<defs>(.*?)</defs>\s*',re.S)
+_GLYPH=re.compile(r'<path id=(["\'])([^"\']+)\1 d=(["\'])([^"\']*)\3\s*/>\s*')
+_HREF=re.compile(r'xlink:href=(["\'])#([^"\']+)\1')
+_D=re.compile(r'\bd=(["\'])([^"\']*)\1')
+_ELEMENT=re.compile(r'<(?:use|rect)\b[^>]*>')
+_XY=re.compile(r'\b(x|y|width|height)=(["\'])([-0-9.e]+)\2')
+_PATH=re.compile(r'([MmZzLlHhVvCcSsQqTt])|([-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)')
+
+
+def number(x, precision):
+    # Shortest writing of x rounded to precision decimals: 0.500 -> .5
+    text='{:.{}f}'.format(float(x),precision)
+    if '.' in text:
+        text=text.rstrip('0').rstrip('.')
+    if text.startswith('0.'):
+        text=text[1:]
+    elif text.startswith('-0.'):
+        text='-'+text[2:]
+    return '0' if text in ['-0',''] else text
+
+
+def optimizePath(d, precision=3):
+    # Rounds the numbers of path data and drops separators and repeated commands
+    if re.search(r'[Aa]',d):    # Arc flags may be glued together, left alone
+        return d
+    out=[]
+    last=None
+    for command,value in _PATH.findall(d):
+        if command:
+            if command!=last or command in 'MmZz':
+                out.append(command)
+            last=command
+            continue
+        value=number(value,precision)
+        previous=out[-1] if out else ''
+        if previous and not previous.isalpha() and not value.startswith('-') \
+                and not (value.startswith('.') and '.' in previous):
+            out.append(' ')
+        out.append(value)
+    return ''.join(out)
+
+
+def glyphId(d):
+    # The same outline gets the same id in every run
+    return 'lq'+hashlib.sha1(d.encode('utf-8')).hexdigest()[:12]
+
+
+def optimize(svgs, sprite='glyphs.svg', precision=3):
+    # Rewrites the svgs to use the glyphs of sprite, next to the first one and
+    # merged with its current glyphs (or only merges identical glyphs in each
+    # svg if sprite is ''). Returns the sizes in bytes before and after, sprite
+    # included.
+    glyphs={}   # Path data -> shared id
+    before=after=0
+    folder=os.path.dirname(os.path.abspath(svgs[0])) if svgs else '.'
+    if sprite and os.path.isfile(os.path.join(folder,sprite)):
+        with open(os.path.join(folder,sprite),'rb') as f:
+            data=f.read()
+        before+=len(data)
+        glyphs.update((g.group(4),g.group(2)) for g in _GLYPH.finditer(data.decode('utf-8')))
+    for filename in svgs:
+        with open(filename,'rb') as f:
+            svg=f.read().decode('utf-8')
+        before+=len(svg.encode('utf-8'))
+        svg=_rewrite(svg,glyphs,sprite,precision,os.path.relpath(os.path.join(folder,sprite),\
+                os.path.dirname(os.path.abspath(filename))) if sprite else '')
+        data=svg.encode('utf-8')
+        after+=len(data)
+        tmp=_tmpName(filename)
+        with open(tmp,'wb') as f:
+            f.write(data)
+        os.rename(tmp,filename)
+    if sprite and glyphs:
+        data=_sprite(glyphs).encode('utf-8')
+        after+=len(data)
+        tmp=_tmpName(os.path.join(folder,sprite))
+        with open(tmp,'wb') as f:
+            f.write(data)
+        os.rename(tmp,os.path.join(folder,sprite))
+    return dict(svgs=len(svgs),glyphs=len(glyphs),before=before,after=after)
+
+
+def _rewrite(svg, glyphs, sprite, precision, href):
+    # The svg without its glyph paths, its <use> pointing to the shared ones.
+    # The desc at the end (LaTeX code) is left untouched.
+    i=svg.find('<desc>')
+    svg,desc=(svg[:i],svg[i:]) if i>=0 else (svg,'')
+    ids={}  # This svg's glyph id -> shared id
+    def defs(m):
+        def glyph(g):
+            d=optimizePath(g.group(4),precision)
+            if d not in glyphs:
+                glyphs[d]=glyphId(d)
+            ids[g.group(2)]=glyphs[d]
+            return ''
+        rest=_GLYPH.sub(glyph,m.group(1))
+        if sprite and not rest.strip():
+            return ''
+        if not sprite:  # The glyphs this svg uses stay in it, once each
+            rest=''.join(sorted(set('<path id="{}" d="{}"/>\n'.format(glyphs[d],d) \
+                    for d in glyphs if glyphs[d] in ids.values())))+rest.lstrip()
+        return '<defs>\n{}</defs>\n'.format(rest)
+    svg=_DEFS.sub(defs,svg,1)
+    svg=_HREF.sub(lambda m:'xlink:href="{}#{}"'.format(href,ids[m.group(2)]) \
+            if m.group(2) in ids else m.group(0),svg)
+    svg=_D.sub(lambda m:'d="{}"'.format(optimizePath(m.group(2),precision)),svg)
+    svg=_ELEMENT.sub(lambda m:_XY.sub(lambda a:'{}="{}"'.format(a.group(1),\
+            number(a.group(3),precision)),m.group(0)),svg)
+    return svg+desc
+
+
+def _sprite(glyphs):
+    paths=''.join('<path id="{}" d="{}"/>\n'.format(i,d) for d,i in \
+            sorted(glyphs.items(),key=lambda i:i[1]))
+    return '<?xml version="1.0" encoding="UTF-8"?>\n'\
+           '<svg xmlns="http://www.w3.org/2000/svg">\n<defs>\n'+paths+'</defs>\n</svg>\n'
+
+
+def _optimize(args):
+    precision,sprite,svgs=3,'glyphs.svg',[]
+    while args:
+        if args[0]=='--precision':
+            precision,args=int(args[1]),args[2:]
+        elif args[0]=='--sprite':
+            sprite,args=args[1],args[2:]
+        else:
+            if os.path.isdir(args[0]):
+                svgs+=sorted(os.path.join(args[0],i) for i in os.listdir(args[0]) \
+                        if i.endswith('.svg') and i!=sprite)
+            else:
+                svgs.append(args[0])
+            args=args[1:]
+    report=optimize(svgs,sprite,precision)
+    print('{svgs} svgs, {glyphs} distinct glyphs: {before} -> {after} bytes'.format(**report)+\
+            ' ({:+.1f}%)'.format(100.*(report['after']-report['before'])/max(report['before'],1)))
+    return 0
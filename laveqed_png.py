@@ -0,0 +1,70 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# Headless rasterization of laveqed svgs to png with librsvg and cairo, spread
+# over a process pool. Never imports Tkinter.
+import os, time
+from laveqed import makesvgs, readManifest, _fromJob
+
+_surface=None    # Reused by the renders of a worker process when the size allows it
+
+
+def rasterize(svgname,dpi=96,pngname=None):
+    # Writes svgname as a png at dpi, next to it by default. Returns the png name.
+    global _surface
+    import rsvg
+    pngname=pngname or os.path.splitext(svgname)[0]+'.png'
+    with rsvg.Handle(path=svgname) as svg:
+        svg.set_dpi(dpi)
+        _surface=svg.render_surface(1,_surface)
+    _surface.write_to_png(pngname)
+    return pngname
+
+
+def _rasterizeJob(job):
+    svgname,dpi=job
+    start=time.time()
+    try:
+        rasterize(svgname,dpi)
+        return svgname,None,time.time()-start
+    except Exception as e:
+        return svgname,str(e),time.time()-start
+
+
+# laveqed --png [--dpi N] <file.svg | folder | equations.txt> ...
+# Manifests are rendered to svg (in one LaTeX run) before being rasterized.
+def _png(args):
+    import multiprocessing
+    dpi=96
+    if len(args)>1 and args[0]=='--dpi':
+        dpi,args=float(args[1]),args[2:]
+    svgs=[]
+    for i in args:
+        if os.path.isdir(i):
+            for path,dirs,files in os.walk(i):
+                svgs+=[os.path.join(path,j) for j in sorted(files) if j.endswith('.svg')]
+        elif i.endswith('.svg'):
+            svgs.append(i)
+        else:
+            eqs=[_fromJob(j) for j in readManifest(i)]
+            failed=makesvgs(eqs,name=os.path.splitext(os.path.basename(i))[0])
+            for eq in failed:
+                print('Failed\t{}.svg'.format(eq.name))
+            svgs+=[eq.name+'.svg' for eq in eqs if eq not in failed]
+    start=time.time()
+    errors=0
+    pool=multiprocessing.Pool()
+    try:
+        for svgname,error,duration in pool.imap_unordered(_rasterizeJob,[(i,dpi) for i in svgs],16):
+            if error is None:
+                print('Done\t{}\t{:.3f}s'.format(svgname,duration))
+            else:
+                errors+=1
+                print('Failed\t{}\t{}'.format(svgname,error))
+    finally:
+        pool.close()
+        pool.join()
+    duration=time.time()-start
+    print('{} of {} svgs rasterized at {:g} dpi in {:.2f}s ({:.1f} svgs/s)'.format(\
+            len(svgs)-errors,len(svgs),dpi,duration,len(svgs)/max(duration,1e-9)))
+    return 1 if errors else 0
+
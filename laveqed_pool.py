@@ -0,0 +1,240 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# Pool of warm latex processes: each one has the preamble format loaded and sits
+# waiting for the name of a document body on its stdin, so a render only pays
+# for typesetting the equation itself.
+import subprocess, threading, tempfile, shutil, os
+from laveqed import laveqed, preambleFormat, scratchDir, parseLog, LatexError, _remove
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+# Loaded after the format; reads which file to typeset from the terminal
+_DRIVER = '\\endlinechar=-1\n'\
+          '\\read16 to \\laveqedjob\n'\
+          '\\endlinechar=13\n'\
+          '\\batchmode\n'\
+          '\\input{\\laveqedjob}\n'
+
+
+class _WarmLatex(object):
+    # A single-use latex process, spawned ahead of time
+
+    def __init__(self, fmt, workdir, jobname):
+        self.workdir=workdir
+        self.jobname=jobname
+        self._devnull=open(os.devnull,'w')
+        self.proc=subprocess.Popen(['latex','-fmt='+fmt,'-interaction=scrollmode',\
+                '-jobname='+jobname,'driver.tex'],cwd=workdir,\
+                stdin=subprocess.PIPE,stdout=self._devnull,stderr=self._devnull)
+
+    def alive(self):
+        return self.proc.poll() is None
+
+    def run(self, body, timeout):
+        # Typesets body (starting at \begin{document}), returns latex's exit code
+        with open(os.path.join(self.workdir,self.jobname+'-body.tex'),'w') as f:
+            f.write(body)
+        timer=threading.Timer(timeout,self.kill)
+        timer.start()
+        try:
+            self.proc.stdin.write((self.jobname+'-body.tex\n').encode())
+            self.proc.stdin.close()
+            ret=self.proc.wait()
+        except (IOError,OSError):   # Died before getting the job
+            ret=-1
+        finally:
+            timer.cancel()
+            self._devnull.close()
+        return ret
+
+    def kill(self):
+        try:
+            self.proc.kill()
+        except OSError:
+            pass
+        self.proc.wait()
+        self._devnull.close()
+
+
+class Job(object):
+    # Handle on a submitted render; wait() returns True if the svg was made
+
+    def __init__(self, eq, callback=None):
+        self.eq=eq
+        self.dest=os.path.abspath(eq.name+'.svg')
+        self.callback=callback
+        self.ok=None
+        self.error=None
+        self._done=threading.Event()
+
+    def wait(self, timeout=None):
+        self._done.wait(timeout)
+        return self.ok
+
+    def _finish(self, ok, error=None):
+        self.ok,self.error=ok,error
+        self._done.set()
+        if self.callback is not None:
+            self.callback(self)
+
+
+class _Worker(threading.Thread):
+
+    def __init__(self, pool, n):
+        threading.Thread.__init__(self,name='laveqed-worker-{}'.format(n))
+        self.daemon=True
+        self.pool=pool
+        self.jobs=0     # Done since the last restart
+        self.restarts=0
+        self.latex=None
+        self._count=0
+        self.workdir=tempfile.mkdtemp(prefix='laveqed-worker-',dir=scratchDir())
+        self._spawn()
+
+    def _spawn(self):
+        if self.pool.fmt is None:
+            return
+        with open(os.path.join(self.workdir,'driver.tex'),'w') as f:
+            f.write(_DRIVER)
+        self._count+=1
+        self.latex=_WarmLatex(self.pool.fmt,self.workdir,'job{}'.format(self._count))
+
+    def restart(self):
+        # Fresh scratch folder and latex process, e.g. after a fatal error
+        if self.latex is not None and self.latex.alive():
+            self.latex.kill()
+        shutil.rmtree(self.workdir,ignore_errors=True)
+        self.workdir=tempfile.mkdtemp(prefix='laveqed-worker-',dir=scratchDir())
+        self.jobs=0
+        self.restarts+=1
+        self._spawn()
+
+    def healthy(self):
+        return self.pool.fmt is None or (self.latex is not None and self.latex.alive())
+
+    def run(self):
+        while True:
+            job=self.pool._queue.get()
+            if job is None:
+                break
+            if not self.healthy():  # Died while idle
+                self.restart()
+            try:
+                ok,error=self._render(job)
+            except Exception as e:
+                ok,error=False,str(e)
+            if not ok:
+                self.restart()
+            elif self.jobs>=self.pool.maxJobs:
+                self.restart()
+            job._finish(ok,error)
+        if self.latex is not None and self.latex.alive():
+            self.latex.kill()
+        shutil.rmtree(self.workdir,ignore_errors=True)
+
+    def _render(self, job):
+        eq=job.eq
+        cache=eq._getCache()
+        if cache is not None and cache.fetch(cache.key(eq),job.dest):
+            return True,None
+        if self.latex is None or (eq.preamble,eq.postamble)!=(self.pool.preamble,self.pool.postamble):
+            eq.makesvg()    # Not what the warm processes have loaded
+            return os.path.isfile(job.dest),None
+        latex=self.latex
+        self._spawn()   # The next one loads its format while this one typesets
+        self.jobs+=1
+        body='\\begin{document}'+eq._getTexCode().partition('\\begin{document}')[2]
+        ret=latex.run(body,self.pool.timeout)
+        base=os.path.join(self.workdir,latex.jobname)
+        if ret:
+            errors=parseLog(base+'.log',eq._equationOffset(self.pool.fmt),eq.equation.count('\n')+1)
+            return False,str(LatexError(errors,ret))
+        with open(os.devnull,'w') as devnull:
+            ret=subprocess.call(['dvisvgm','--exact','-c','{0},{0}'.format(eq.scale),'-n',\
+                    '-o',base+'.svg',base+'.dvi'],stdout=devnull,stderr=devnull)
+        try:
+            if ret:
+                return False,'dvisvgm exited with code {}'.format(ret)
+            name,eq.name=eq.name,os.path.splitext(job.dest)[0]
+            try:
+                with open(base+'.svg','rb') as f:
+                    eq._commentSVG(f)   # Written to job.dest in one rename
+            finally:
+                eq.name=name
+        finally:
+            _remove([base+i for i in ['.tex','-body.tex','.aux','.log','.dvi','.svg']])
+        if cache is not None:
+            cache.store(cache.key(eq),job.dest)
+        return True,None
+
+
+class WorkerPool(object):
+    # Renders laveqed objects on n workers, each keeping a latex process warm
+    # with the preamble loaded. Workers are recycled every maxJobs renders and
+    # after any failure; renders taking longer than timeout seconds are killed.
+
+    def __init__(self, n=None, preamble=None, postamble=None, maxJobs=200, timeout=30):
+        default=laveqed()
+        self.preamble=default.preamble if preamble is None else preamble
+        self.postamble=default.postamble if postamble is None else postamble
+        self.maxJobs=maxJobs
+        self.timeout=timeout
+        head,begin,body=self.preamble.partition('\\begin{document}')
+        self.fmt=preambleFormat(head) if begin else None
+        self._queue=queue.Queue()
+        self.workers=[_Worker(self,i) for i in range(n or _cpuCount())]
+        for i in self.workers:
+            i.start()
+
+    def submit(self, eq, callback=None):
+        job=Job(eq,callback)
+        try:
+            if eq.validate:
+                eq.check()  # No need to bother (and recycle) a worker
+        except LatexError as e:
+            job._finish(False,str(e))
+            return job
+        self._queue.put(job)
+        return job
+
+    def render(self, eq):
+        return self.submit(eq).wait()
+
+    def map(self, eqs):
+        # Renders every equation, returns the list of objects that failed
+        jobs=[self.submit(i) for i in eqs]
+        return [i.eq for i in jobs if not i.wait()]
+
+    def healthcheck(self):
+        # Replaces dead workers and returns the state of each of them. Workers
+        # whose latex process died respawn it before their next job.
+        state=[]
+        for n,i in enumerate(self.workers):
+            if not i.is_alive():
+                i=self.workers[n]=_Worker(self,n)
+                i.restarts=1
+                i.start()
+            state.append(dict(name=i.name,latex=i.healthy(),jobs=i.jobs,restarts=i.restarts))
+        return state
+
+    def close(self):
+        for i in self.workers:
+            self._queue.put(None)
+        for i in self.workers:
+            i.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _cpuCount():
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    except (ImportError,NotImplementedError):
+        return 1
@@ -0,0 +1,277 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# Incremental rendering of long align* blocks, reached through
+# laveqed.makesvg_incremental(). Every row is typeset on its own with the
+# block's column widths and cached as a svg fragment, keyed on its content
+# and those widths; the svg is then composed from the fragments. LaTeX only
+# runs for the rows that changed, and for every row when they change the
+# width of a column.
+#
+# The layout follows align*'s: a right and a left aligned column, rows spaced
+# by \baselineskip+\jot. Blocks with more columns are rendered the usual way,
+# as align* spreads column pairs over the line width. Rows that can't be
+# typeset on their own fall back to makesvg.
+import re, io, json, glob
+from collections import OrderedDict
+from laveqed import LatexError, parseLog, Now, _openEnvs, _workspace, _call, _remove
+
+MINROWS=4   # Fewer rows than that are rendered the usual way
+
+# Anything that isn't a plain row: \\[1ex], \\*, tags, text between rows...
+_SPECIAL=re.compile(r'\\\\\s*[\[*]|\\(?:intertext|shortintertext|tag|notag|nonumber|label'
+                    r'|displaybreak|noalign|hline)\b')
+_TOKENS=re.compile(r'\\(begin|end)\s*\{[^{}]*\}|\\\\|\\[a-zA-Z@]+|\\.|%.*|[{}&]')
+_MACROS=r'''\newbox\lqbox \newif\iflqwider \newdimen\lqsep \lqsep=2em
+\def\lqW#1{\csname lqW#1\endcsname}
+\def\lqnew#1#2{\expandafter\newdimen\csname lqW#1\endcsname \lqW{#1}=#2\relax}
+\def\lqmeasure#1#2#3{\setbox\lqbox\hbox{\ifodd#2 $\displaystyle#3$\else$\displaystyle{}#3$\fi}%
+  \typeout{laveqed-cell #1 #2 \the\wd\lqbox}%
+  \ifdim\wd\lqbox>\lqW{#2}\lqW{#2}=\wd\lqbox\lqwidertrue\fi}
+\def\lqfix#1#2{\hbox to\lqW{#1}{\ifodd#1 \hfil$\displaystyle#2$\else$\displaystyle{}#2$\hfil\fi}}
+\def\lqship#1#2{\setbox\lqbox\hbox{#2}\typeout{laveqed-page #1 \the\ht\lqbox\space\the\dp\lqbox}%
+  \shipout\hbox{\special{dvisvgm:bbox r \the\wd\lqbox\space\the\ht\lqbox\space\the\dp\lqbox}%
+  \special{dvisvgm:bbox lock}\box\lqbox}}
+'''
+
+
+class _Row(object):
+    # What RenderCache.key() looks at, for a fragment or the metrics of a row
+
+    def __init__(self, eq, text):
+        self.preamble,self.postamble,self.scale=eq.preamble,eq.postamble,eq.scale
+        self.equation=text
+
+
+def splitRows(equation):
+    # The cells of each row, split at the top level \\ and &, comments dropped
+    rows=[[]]
+    cell=[]
+    depth=0
+    last=0
+    for m in _TOKENS.finditer(equation):
+        cell.append(equation[last:m.start()])
+        last=m.end()
+        token=m.group(0)
+        if token.startswith('%'):
+            continue
+        if depth==0 and token in ['\\\\','&']:
+            rows[-1].append(''.join(cell).strip())
+            cell=[]
+            if token=='\\\\':
+                rows.append([])
+            continue
+        if token=='{' or m.group(1)=='begin':
+            depth+=1
+        elif token=='}' or m.group(1)=='end':
+            depth-=1
+        cell.append(token)
+    cell.append(equation[last:])
+    rows[-1].append(''.join(cell).strip())
+    if rows[-1]==['']:  # Trailing \\
+        rows.pop()
+    return rows
+
+
+def incremental(eq):
+    # True if eq can be rendered row by row
+    envs=_openEnvs(eq.preamble)
+    return bool(envs) and envs[-1]=='align*' and eq._getCache('.row') is not None \
+            and not _SPECIAL.search(eq.equation) and eq.equation.count('\\\\')+1>=MINROWS \
+            and max(len(i) for i in splitRows(eq.equation))<=2
+
+
+def makesvg_incremental(eq):
+    if not incremental(eq):
+        return eq.makesvg()
+    if eq.validate:
+        eq.check()
+    rows=splitRows(eq.equation)
+    if len(rows)<MINROWS:
+        return eq.makesvg()
+    metricsCache,fragmentCache=eq._getCache('.row'),eq._getCache('.rowsvg')
+    columns=max(len(i) for i in rows)
+    rows=[i+['']*(columns-len(i)) for i in rows]
+    texts=['&'.join(i) for i in rows]
+    eq.timings=OrderedDict()
+    eq.workdir=_workspace()
+    try:
+        with eq._stage('render') as info:
+            with eq._stage('cache'):
+                metrics=[_fetchJSON(metricsCache,_Row(eq,i),eq._base()+'.json') for i in texts]
+                widths=_widths([i for i in metrics if i],columns)
+                keys=[fragmentCache.key(_Row(eq,_fragmentText(eq,i,widths))) for i in texts]
+                fragments=[_fetch(fragmentCache,k,eq._base()+'.rowsvg') if m else None \
+                        for k,m in zip(keys,metrics)]
+            info.update(rows=len(rows),changed=sum(1 for i in metrics if i is None))
+            if None in fragments:
+                metrics,widths,fragments=_render(eq,rows,texts,metrics,widths,fragments)
+            with eq._stage('compose'):
+                svg=_compose(fragments,metrics,widths)
+            with eq._stage('write'):
+                eq._commentSVG(io.BytesIO(svg.encode('utf-8')))
+        return
+    except LatexError:
+        pass    # The rows don't compile on their own, maybe the whole block does
+    finally:
+        eq._closeWorkspace()
+    # makesvg also reports the errors on the lines of the equation
+    return eq.makesvg()
+
+
+def _render(eq, rows, texts, metrics, widths, fragments):
+    # One latex run measuring the new rows and typesetting every row missing a
+    # fragment, plus all the others if the new rows widen a column
+    metricsCache,fragmentCache=eq._getCache('.row'),eq._getCache('.rowsvg')
+    base=eq._base()
+    fmt=eq._getFormat()
+    head=eq.preamble.replace('%NOW%',Now()).partition('\\begin{document}')[0]
+    code=['' if fmt else head,'\\begin{document}\n',_MACROS]
+    code.append('\\typeout{laveqed-skips \\the\\baselineskip\\space\\the\\lineskip'
+                '\\space\\the\\lineskiplimit\\space\\the\\jot\\space\\the\\lqsep}\n')
+    for c in range(len(widths)):
+        code.append('\\lqnew{{{}}}{{{}}}\n'.format(c+1,widths[c]))
+    for r,row in enumerate(rows):
+        if metrics[r] is None:
+            code+=['\\lqmeasure{{{}}}{{{}}}{{{}}}\n'.format(r,c+1,i) for c,i in enumerate(row)]
+    for c in range(len(widths)):
+        code.append('\\typeout{{laveqed-width {0} \\the\\lqW{{{0}}}}}\n'.format(c+1))
+    ships=[_ship(r,row) for r,row in enumerate(rows)]
+    code+=[ships[r] for r in range(len(rows)) if fragments[r] is None]
+    code+=['\\iflqwider\n']+[ships[r] for r in range(len(rows)) if fragments[r] is not None]+['\\fi\n']
+    code.append('\\end{document}\n')
+    with open(base+'.tex','w') as f:
+        f.write(''.join(code))
+    with eq._stage('latex') as info:
+        command=['latex','-interaction=batchmode','-output-directory='+eq.workdir,base+'.tex']
+        if fmt:
+            command.insert(1,'-fmt='+fmt)
+        ret=info['returncode']=_call(command,owner=eq)
+    if ret:     # makesvg_incremental falls back to makesvg
+        eq._checkCancelled()
+        raise LatexError(parseLog(base+'.log'),ret)
+    log=_readLog(base+'.log')
+    with eq._stage('dvisvgm') as info:
+        ret=info['returncode']=_call(['dvisvgm','--exact','-c','{0},{0}'.format(eq.scale),'-n',\
+                '-p','1-','-o',base+'-%p.svg',base+'.dvi'],owner=eq)
+    if ret:
+        eq._checkCancelled()
+        raise LatexError([dict(message='dvisvgm exited with code {}'.format(ret),line=None)],ret)
+    # Metrics of the new rows, widths, then the fragments in the order they were shipped
+    widths=[log['width'][str(c+1)] for c in range(len(widths))]
+    cells={}
+    for r,c,w in log['cell']:
+        cells.setdefault(int(r),{})[int(c)]=w
+    pages=sorted(glob.glob(base+'-*.svg'),key=lambda i:int(i[len(base)+1:-4]))
+    if len(pages)!=len(log['page']):
+        raise LatexError([dict(message='{} rows typeset, {} svgs'.format(len(log['page']),\
+                len(pages)),line=None)])
+    for (r,ht,dp),page in zip(log['page'],pages):
+        r=int(r)
+        if metrics[r] is None:
+            metrics[r]=dict(cells=[cells[r][c+1] for c in range(len(widths))],ht=ht,dp=dp,\
+                    skips=log['skips'])
+            _storeJSON(metricsCache,_Row(eq,texts[r]),metrics[r],base+'.json')
+        fragmentCache.store(fragmentCache.key(_Row(eq,_fragmentText(eq,texts[r],widths))),page)
+        with open(page,'rb') as f:
+            fragments[r]=f.read().decode('utf-8')
+    _remove(pages)
+    return metrics,widths,fragments
+
+
+def _ship(r, row):
+    cells=[]
+    for c,i in enumerate(row):
+        if c and c%2==0:
+            cells.append('\\hskip\\lqsep')
+        cells.append('\\lqfix{{{}}}{{{}}}'.format(c+1,i))
+    return '\\lqship{{{}}}{{{}}}\n'.format(r,''.join(cells))
+
+
+def _readLog(logname):
+    # The laveqed-* lines latex wrote in its log, by kind
+    log=dict(cell=[],page=[],width={},skips=None)
+    with open(logname,'rb') as f:
+        for line in f.read().decode('utf-8','replace').split('\n'):
+            if not line.startswith('laveqed-'):
+                continue
+            words=line.split()
+            kind=words[0][8:]
+            if kind=='width':
+                log['width'][words[1]]=words[2]
+            elif kind=='skips':
+                log['skips']=words[1:]
+            else:
+                log[kind].append(words[1:])
+    return log
+
+
+def _pt(dimen):
+    return float(dimen[:-2])
+
+
+def _widths(metrics, columns):
+    # Widest cell of each column among the known rows, as TeX wrote it
+    widths=['0.0pt']*columns
+    for i in metrics:
+        widths=[max(w,c,key=_pt) for w,c in zip(widths,i['cells'])]
+    return widths
+
+
+def _fragmentText(eq, text, widths):
+    return 'fragment\0{}\0{}\0{}'.format(text,';'.join(widths),eq.scale)
+
+
+def _fetch(cache, key, tmp):
+    if not cache.fetch(key,tmp):
+        return None
+    with open(tmp,'rb') as f:
+        return f.read().decode('utf-8')
+
+
+def _fetchJSON(cache, row, tmp):
+    data=_fetch(cache,cache.key(row),tmp)
+    return json.loads(data) if data else None
+
+
+def _storeJSON(cache, row, data, tmp):
+    with open(tmp,'w') as f:
+        json.dump(data,f)
+    cache.store(cache.key(row),tmp)
+
+
+_ROOT=re.compile(r'<svg\b[^>]*>')
+_ATTRIBUTE=r'\b{}=["\']([^"\']*)["\']'
+
+
+def _compose(fragments, metrics, widths):
+    # Stacks the fragments the way TeX spaces the rows of an alignment
+    baselineskip,lineskip,limit,jot,sep=[_pt(i) for i in metrics[0]['skips']]
+    rowwidth=sum(_pt(i) for i in widths)+sep*((len(widths)-1)//2)
+    parts=[]
+    y=None
+    for n,(svg,m) in enumerate(zip(fragments,metrics)):
+        ht,dp=_pt(m['ht']),_pt(m['dp'])
+        if y is None:
+            y=ht
+        else:
+            gap=baselineskip+jot-depth-ht
+            y+=baselineskip+jot if gap>=limit+jot else depth+ht+lineskip+jot
+        depth=dp
+        root=_ROOT.search(svg)
+        vb=[float(i) for i in re.search(_ATTRIBUTE.format('viewBox'),root.group(0)).group(1).split()]
+        if n==0:
+            k=vb[2]/rowwidth if rowwidth else 1  # svg units per pt
+            width=re.search(_ATTRIBUTE.format('width'),root.group(0)).group(1)
+            unit=re.sub(r'[-0-9.]','',width)
+            r=float(width[:len(width)-len(unit)])/vb[2] if vb[2] else 1
+        inner=svg[root.end():svg.rindex('</svg>')]
+        inner=re.sub(r'\bid=(["\'])',r'id=\1r{}-'.format(n),inner)
+        inner=re.sub(r'(href=["\']#|url\(#)',r'\1r{}-'.format(n),inner)
+        parts.append('<svg x="{:.6g}" y="{:.6g}" width="{:.6g}" height="{:.6g}" viewBox="{}" '\
+                'overflow="visible">{}</svg>\n'.format(0,(y-ht)*k,vb[2],vb[3],\
+                ' '.join('{:.6g}'.format(i) for i in vb),inner))
+    height=(y+depth)*k
+    return '<?xml version="1.0" encoding="UTF-8"?>\n'\
+           '<svg version="1.1" xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink" '\
+           'width="{:.6g}{}" height="{:.6g}{}" viewBox="0 0 {:.6g} {:.6g}">\n{}</svg>\n'.format(\
+           rowwidth*k*r,unit,height*r,unit,rowwidth*k,height,''.join(parts))
@@ -0,0 +1,245 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# Local render server: one warm process shared by many clients. Identical
+# requests in flight are merged into one compile, and requests arriving
+# together are rendered as a batch (one latex run per preamble, see makesvgs).
+#
+#   laveqed --serve [PORT|HOST:PORT|/path/to/socket]
+#
+#   POST /render   {"equation": "F=ma", "scale": 4, "preamble": ..., "postamble": ...}
+#                  -> the svg; with "dest": "/path/eq.svg" it's written there
+#                  and {"dest": ...} is returned instead
+#   POST /extract  {"path": "/path/eq.svg"}, or a svg as the body -> its metadata
+#   GET  /stats    -> requests, merged requests, batches, latency, ...
+import os, io, json, time, shutil, threading
+from laveqed import laveqed, makesvgs, readMetadata, _fromJob, _workspace, _tmpName
+try:
+    import queue
+    import socketserver
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+except ImportError:
+    import Queue as queue
+    import SocketServer as socketserver
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+DEFAULTPORT=8765
+TIMEOUT=120 # Seconds a client waits for its render
+
+
+class _Request(object):
+    # One compile, shared by every client asking for the same equation
+
+    def __init__(self, eq):
+        self.eq=eq
+        self.data=None
+        self.error=None
+        self.waiters=1
+        self._done=threading.Event()
+
+    def wait(self, timeout=None):
+        self._done.wait(timeout)
+        return self.data
+
+    def _finish(self, data, error=None):
+        self.data,self.error=data,error
+        self._done.set()
+
+
+class Renderer(object):
+    # Renders laveqed objects on n threads. Each thread takes the requests
+    # queued within window seconds of the first one (at most maxBatch) and
+    # renders them together.
+
+    def __init__(self, n=2, window=0.02, maxBatch=64):
+        self.window=window
+        self.maxBatch=maxBatch
+        self.started=time.time()
+        self.counts=dict(requests=0,merged=0,renders=0,batches=0,errors=0,extracts=0)
+        self.latencies=[]   # Seconds, of the last 1000 requests
+        self._inflight={}
+        self._lock=threading.Lock()
+        self._queue=queue.Queue()
+        self._threads=[threading.Thread(target=self._run,name='laveqed-render-{}'.format(i)) \
+                for i in range(n)]
+        for i in self._threads:
+            i.daemon=True
+            i.start()
+
+    def render(self, eq, timeout=TIMEOUT):
+        # Returns the svg of eq (bytes); raises RuntimeError if it fails
+        start=time.time()
+        key=(eq.preamble,eq.equation,eq.postamble,str(eq.scale))
+        with self._lock:
+            self.counts['requests']+=1
+            request=self._inflight.get(key)
+            if request is None:
+                request=self._inflight[key]=_Request(eq)
+                self._queue.put((key,request))
+            else:
+                request.waiters+=1
+                self.counts['merged']+=1
+        data=request.wait(timeout)
+        with self._lock:
+            self.latencies=self.latencies[-999:]+[time.time()-start]
+        if data is None:
+            raise RuntimeError(request.error or 'timed out')
+        return data
+
+    def _run(self):
+        while True:
+            batch=[self._queue.get()]
+            deadline=time.time()+self.window
+            while len(batch)<self.maxBatch:
+                try:
+                    batch.append(self._queue.get(timeout=max(deadline-time.time(),0)))
+                except queue.Empty:
+                    break
+            self._render(batch)
+
+    def _render(self, batch):
+        # Every request of the batch is finished, whatever goes wrong: a client
+        # left waiting would wait forever
+        work=error=None
+        svgs={}
+        try:
+            work=_workspace()
+            for n,(key,request) in enumerate(batch):
+                request.eq.name=os.path.join(work,'eq{}'.format(n))
+            failed=makesvgs([request.eq for key,request in batch],os.path.join(work,'batch'))
+            for key,request in batch:
+                if request.eq not in failed:
+                    with open(request.eq.name+'.svg','rb') as f:
+                        svgs[key]=f.read()
+        except Exception as e:
+            error=e
+        finally:
+            with self._lock:
+                self.counts['batches']+=1
+                self.counts['renders']+=len(batch)
+                self.counts['errors']+=len(batch)-len(svgs)
+                for key,request in batch:
+                    self._inflight.pop(key,None)   # Later requests compile (or hit the cache) anew
+            for key,request in batch:
+                if key in svgs:
+                    request._finish(svgs[key])
+                else:
+                    request._finish(None,str(request.eq.error or error or \
+                            'LaTeX could not render the equation'))
+            if work:
+                shutil.rmtree(work,ignore_errors=True)
+
+    def stats(self):
+        with self._lock:
+            stats=dict(self.counts)
+            latencies=sorted(self.latencies)
+            stats['inflight']=len(self._inflight)
+        stats['uptime']=time.time()-self.started
+        stats['throughput']=stats['requests']/max(stats['uptime'],1e-9)   # Requests per second
+        if latencies:
+            stats['latency']=dict(p50=latencies[len(latencies)//2],\
+                    p95=latencies[int(len(latencies)*.95)],max=latencies[-1])
+        return stats
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path=='/stats':
+            return self._reply(200,self.server.renderer.stats())
+        self._reply(404,dict(error='Unknown path '+self.path))
+
+    def do_POST(self):
+        body=self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        try:
+            if self.path=='/render':
+                return self._render(json.loads(body.decode('utf-8')))
+            elif self.path=='/extract':
+                return self._extract(body)
+            self._reply(404,dict(error='Unknown path '+self.path))
+        except (ValueError,KeyError,SyntaxError) as e: # Bad JSON or XML, no equation, not laveqed's...
+            self._reply(400,dict(error=str(e)))
+        except RuntimeError as e:   # LaTeX failed
+            self._reply(422,dict(error=str(e)))
+        except (IOError,OSError) as e:  # No svg at path, dest can't be written...
+            self._reply(400,dict(error=str(e)))
+
+    def _render(self, job):
+        if not isinstance(job,dict) or 'equation' not in job:
+            raise ValueError('Expected a JSON object with an equation')
+        job['name']=''
+        data=self.server.renderer.render(_fromJob(job))
+        if not job.get('dest'):
+            return self._reply(200,data,'image/svg+xml')
+        tmp=_tmpName(job['dest'])
+        with open(tmp,'wb') as f:
+            f.write(data)
+        os.rename(tmp,job['dest'])
+        self._reply(200,dict(dest=job['dest']))
+
+    def _extract(self, body):
+        with self.server.renderer._lock:
+            self.server.renderer.counts['extracts']+=1
+        if body.lstrip().startswith(b'{'):
+            job=json.loads(body.decode('utf-8'))
+            if not isinstance(job,dict):
+                raise ValueError('Expected a JSON object with a path')
+            meta=readMetadata(job['path'])
+        else:   # The svg itself
+            meta=readMetadata(io.BytesIO(body))
+        self._reply(200,meta)
+
+    def _reply(self, code, body, contentType='application/json'):
+        if not isinstance(body,bytes):
+            body=json.dumps(body,sort_keys=True).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type',contentType)
+        self.send_header('Content-Length',str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        return str(self.client_address[0]) if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        pass    # Counted in /stats instead
+
+
+class _TCPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads=True
+
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads=True
+
+    def server_bind(self):
+        socketserver.UnixStreamServer.server_bind(self)
+        self.server_name,self.server_port='localhost',0
+
+
+def serve(address=None, threads=2, window=0.02):
+    # address: a port, 'host:port' or the path of a Unix socket
+    address=str(address or DEFAULTPORT)
+    if os.sep in address:
+        if os.path.exists(address):
+            os.remove(address)  # Left over by a previous server
+        server=_UnixServer(address,_Handler)
+    else:
+        host,colon,port=address.rpartition(':')
+        server=_TCPServer((host or '127.0.0.1',int(port)),_Handler)
+    server.renderer=Renderer(threads,window)
+    return server
+
+
+def _serve(args):
+    server=serve(*args[:1])
+    print('laveqed serving on {}'.format(args[0] if args and os.sep in args[0] else \
+            '{}:{}'.format(*server.server_address)))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if isinstance(server.server_address,str) and os.path.exists(server.server_address):
+            os.remove(server.server_address)
+    return 0
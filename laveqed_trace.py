@@ -0,0 +1,62 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# Exporters for the events laveqed emits (see laveqed.addListener): a Chrome
+# trace, to open in chrome://tracing or Perfetto, and plain JSON lines.
+#
+# From the command line:
+#   LAVEQED_TRACE=trace.json laveqed ...     -> Chrome trace written at exit
+#   LAVEQED_EVENTS=events.jsonl laveqed ...  -> every event, as it happens
+import os, sys, json, time, threading, atexit
+from laveqed import addListener
+
+
+class ChromeTrace(object):
+    # Keeps stages and processes as complete events, the rest as instants
+
+    def __init__(self):
+        self.events=[]
+        self.pid=os.getpid()
+        self._lock=threading.Lock()
+
+    def __call__(self, event):
+        args=dict((k,v) for k,v in event.items() if k not in ['event','start','duration'])
+        if 'start' in event:
+            trace=dict(name=event.get('stage') or event.get('command') or event['event'],ph='X',\
+                    ts=int(1e6*event['start']),dur=int(1e6*event['duration']))
+        else:
+            trace=dict(name=event['event'],ph='i',s='t',ts=int(1e6*time.time()))
+        trace.update(cat=event['event'],pid=self.pid,tid=threading.current_thread().ident,args=args)
+        with self._lock:
+            self.events.append(trace)
+
+    def save(self, filename):
+        with self._lock:
+            events=list(self.events)
+        with open(filename,'w') as f:
+            json.dump(dict(traceEvents=events,displayTimeUnit='ms'),f,default=str)
+
+
+class JSONLines(object):
+    # Writes every event as a line of JSON to an open file
+
+    def __init__(self, f):
+        self.f=f
+        self._lock=threading.Lock()
+
+    def __call__(self, event):
+        line=json.dumps(event,sort_keys=True,default=str)+'\n'
+        with self._lock:
+            self.f.write(line)
+            self.f.flush()
+
+
+def fromEnvironment():
+    # Sets up the exporters asked for by $LAVEQED_TRACE and $LAVEQED_EVENTS
+    if os.environ.get('LAVEQED_TRACE'):
+        trace=ChromeTrace()
+        addListener(trace)
+        atexit.register(trace.save,os.environ['LAVEQED_TRACE'])
+    if os.environ.get('LAVEQED_EVENTS'):
+        filename=os.environ['LAVEQED_EVENTS']
+        lines=JSONLines(sys.stderr if filename=='-' else open(filename,'a'))
+        addListener(lines)
@@ -4,7 +4,7 @@
 # Modified from https://stackoverflow.com/questions/6589358/convert-svg-to-png-in-python/49964454#49964454
 
 from ctypes import CDLL, POINTER, Structure, byref, util
-from ctypes import c_bool, c_byte, c_void_p, c_int, c_double, c_uint32, c_char_p
+from ctypes import c_bool, c_byte, c_void_p, c_int, c_double, c_uint32, c_char_p, c_size_t
 
 
 class _PycairoContext(Structure):
@@ -33,24 +33,35 @@ def _load_rsvg(rsvg_lib_path=None, gobject_lib_path=None):
 
     l.rsvg_handle_new_from_file.argtypes = [c_char_p, POINTER(POINTER(_GError))]
     l.rsvg_handle_new_from_file.restype = c_void_p
+    l.rsvg_handle_new_from_data.argtypes = [c_char_p, c_size_t, POINTER(POINTER(_GError))]
+    l.rsvg_handle_new_from_data.restype = c_void_p
     l.rsvg_handle_render_cairo.argtypes = [c_void_p, c_void_p]
     l.rsvg_handle_render_cairo.restype = c_bool
     l.rsvg_handle_get_dimensions.argtypes = [c_void_p, POINTER(_RsvgProps)]
+    l.rsvg_handle_set_dpi.argtypes = [c_void_p, c_double]
+    g.g_object_unref.argtypes = [c_void_p]
 
-    return l
+    return l, g
 
 
-_librsvg = _load_rsvg()
+_librsvg, _libgobject = _load_rsvg()
 
 
 class Handle(object):
-    def __init__(self, path):
+    opened = 0  # Handles not closed yet, to track leaks
+
+    def __init__(self, path=None, data=None):
+        """Loads the svg file at path, or the svg document given as bytes in data."""
         lib = _librsvg
         err = POINTER(_GError)()
-        self.handle = lib.rsvg_handle_new_from_file(path.encode(), byref(err))
+        if data is not None:
+            self.handle = lib.rsvg_handle_new_from_data(data, len(data), byref(err))
+        else:
+            self.handle = lib.rsvg_handle_new_from_file(path.encode(), byref(err))
         if self.handle is None:
             gerr = err.contents
             raise Exception(gerr.message)
+        Handle.opened += 1
         self.props = _RsvgProps()
         lib.rsvg_handle_get_dimensions(self.handle, byref(self.props))
 
@@ -60,7 +71,46 @@ class Handle(object):
         #return (svgDim.width, svgDim.height)
         return self.props.width, self.props.height
 
+    def set_dpi(self, dpi):
+        """Resolution used to convert physical units (pt, mm, ...) to pixels."""
+        _librsvg.rsvg_handle_set_dpi(self.handle, dpi)
+        _librsvg.rsvg_handle_get_dimensions(self.handle, byref(self.props))
+
     def render_cairo(self, ctx):
         """Returns True is drawing succeeded."""
         z = _PycairoContext.from_address(id(ctx))
         return _librsvg.rsvg_handle_render_cairo(self.handle, z.ctx)
+
+    def render_surface(self, scale=1, surface=None):
+        """Renders into an ARGB32 cairo surface, reusing surface if it has the right size."""
+        import cairo
+        width, height = int(self.props.width*scale), int(self.props.height*scale)
+        if surface is None or (surface.get_width(), surface.get_height()) != (width, height):
+            surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
+        ctx = cairo.Context(surface)
+        ctx.set_operator(cairo.OPERATOR_CLEAR)  # Wipes the previous render
+        ctx.paint()
+        ctx.set_operator(cairo.OPERATOR_OVER)
+        ctx.scale(scale, scale)
+        self.render_cairo(ctx)
+        surface.flush()
+        return surface
+
+    def close(self):
+        """Releases the librsvg object, the handle can't render anymore."""
+        if self.handle is not None:
+            _libgobject.g_object_unref(self.handle)
+            self.handle = None
+            Handle.opened -= 1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:   # Interpreter shutting down
+            pass
@@ -25,10 +25,13 @@ def rsvg_windows():
                             ("ctx", c_void_p),
                             ("base", c_void_p)]
 
-            def __init__(self, path):
+            def __init__(self, path=None, data=None):
                 self.path = path
                 error = ''
-                self.handle = l.rsvg_handle_new_from_file(self.path,error)
+                if data is not None:
+                    self.handle = l.rsvg_handle_new_from_data(data,len(data),error)
+                else:
+                    self.handle = l.rsvg_handle_new_from_file(self.path,error)
 
 
             def get_dimension_data(self):
@@ -42,9 +45,35 @@ def rsvg_windows():
                 l.rsvg_handle_render_cairo(self.handle, z.ctx)
                 ctx.restore()
 
+            def close(self):
+                if self.handle:
+                    g.g_object_unref(self.handle)
+                    self.handle = None
+
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *args):
+                self.close()
+
+            def render_surface(self, scale=1, surface=None):
+                import cairo
+                width, height = self.get_dimension_data()
+                width, height = int(width*scale), int(height*scale)
+                if surface is None or (surface.get_width(), surface.get_height()) != (width, height):
+                    surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
+                ctx = cairo.Context(surface)
+                ctx.set_operator(cairo.OPERATOR_CLEAR)
+                ctx.paint()
+                ctx.set_operator(cairo.OPERATOR_OVER)
+                ctx.scale(scale, scale)
+                self.render_cairo(ctx)
+                surface.flush()
+                return surface
+
         class rsvgClass():
-            def Handle(self,path):
-                return rsvgHandle(path)
+            def Handle(self,path=None,data=None):
+                return rsvgHandle(path,data)
 
         rsvg = rsvgClass()
         return rsvg